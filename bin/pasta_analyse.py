@@ -16,27 +16,69 @@ import sys
 
 from functools import partial
 from logging import getLogger
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count
 from time import sleep
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from pypasta import *
+from pypasta.Profiler import profiled, stage
 
 log = getLogger(__name__[-15:])
 
-_repo = None
 
-
-def _evaluate_patch_list_wrapper(thresholds, args):
-    global _repo
-    orig, cand = args
-    return evaluate_commit_list(_repo, thresholds,
+def _evaluate_patch_list_wrapper(thresholds, prune, top_k, min_rating,
+                                 f_commit_store, args):
+    # Workers only receive the slice of the similarity cache they need
+    orig, cand, cache = args
+    repo = CommitStore.attach(f_commit_store)
+    return evaluate_commit_list(repo, thresholds,
                                 False, EvaluationType.PatchStack,
                                 orig, cand,
-                                parallelise=False)
+                                parallelise=False, prune=prune, cache=cache,
+                                top_k=top_k, min_rating=min_rating)
+
 
+CHERRY_RGXS = re.compile('(' + ')|('.join([r'.*pick.*',
+                                             r'.*upstream.*commit.*',
+                                             r'.*commit.*upstream.*']) + ')',
+                         re.IGNORECASE)
+# Abbreviated hashes have at least seven characters (git's default). Words like
+# 'added' or 'decade' are valid hex strings, so hashes must contain a digit.
+SHA1_REGEX = re.compile(r'\b((?=[a-fA-F]*[0-9])[0-9a-fA-F]{7,40})\b')
 
-def find_cherries(repo, commit_hashes, dest_list):
+
+def _find_cherry_references(repo, commit_hashes):
+    """
+    Returns all (commit_hash, reference) tuples of commit messages that refer
+    to a (possibly abbreviated) commit hash in a line that looks like a
+    cherry-pick annotation, and the number of those lines. A line may refer
+    to several hashes.
+    """
+    references = []
+    lines = 0
+    for commit_hash in commit_hashes:
+        commit = repo[commit_hash]
+        found = set()
+        for line in commit.message:
+            if not CHERRY_RGXS.match(line):
+                continue
+            lines += 1
+
+            for reference in SHA1_REGEX.findall(line):
+                if reference.lower() not in found:
+                    found.add(reference.lower())
+                    references.append((commit_hash, reference))
+
+    return references, lines
+
+
+def _find_cherry_references_pooled(f_commit_store, commit_hashes):
+    return _find_cherry_references(CommitStore.attach(f_commit_store),
+                                   commit_hashes)
+
+
+@profiled('find_cherries')
+def find_cherries(repo, commit_hashes, dest_list, pool=None):
     """
     find_cherries() takes a list of commit hashes, a list of potential
     candidates and the type of the evaluation (PatchStack / Upstream) and tries
@@ -48,41 +90,124 @@ def find_cherries(repo, commit_hashes, dest_list):
     :param repo: Repository
     :param commit_hashes: list of commit-hashes
     :param dest_list: list of potential cherry-pick hashes
+    :param pool: WorkerPool that scans the commit messages. If None, they are
+           scanned sequentially.
     :return: EvaluationResult containing all detected cherry picks
     """
     log.info('Auto-detecting cherry-picks')
     cherries = EvaluationResult()
 
-    cherry_rgxs = [r'.*pick.*', r'.*upstream.*commit.*',
-                   r'.*commit.*upstream.*']
-    cherry_rgxs = re.compile('(' + ')|('.join(cherry_rgxs) + ')', re.IGNORECASE)
-    sha1_regex = re.compile(r'\b([0-9a-fA-F]{5,40})\b')
-
-    for commit_hash in commit_hashes:
-        commit = repo[commit_hash]
-        for line in commit.message:
-            if cherry_rgxs.match(line):
-                sha_found = sha1_regex.search(line)
-                if not sha_found:
-                    continue
-
-                cherry = sha_found.group(1)
-                if cherry in dest_list:
-                    if commit_hash in cherries:
-                        cherries[commit_hash].append((cherry,
-                                                      SimRating(1.0, 1.0, 1.0)))
-                    else:
-                        cherries[commit_hash] = [(cherry,
-                                                  SimRating(1.0, 1.0, 1.0))]
-                else:
-                    log.info('Found cherry-pick %s <-> %s but it is not a '
-                             'valid reference in this context'
-                             % (commit_hash, cherry))
+    # Commit messages often only contain abbreviated hashes
+    with stage('Cherry-pick index', len(dest_list)):
+        index = HashPrefixIndex(dest_list)
+
+    commit_hashes = list(commit_hashes)
+    if pool is None:
+        references, lines = _find_cherry_references(repo, commit_hashes)
+    else:
+        f = partial(_find_cherry_references_pooled,
+                    repo.commit_store(commit_hashes))
+        chunksize = max(len(commit_hashes) // (pool.processes * 4), 1)
+        chunks = [commit_hashes[i:i + chunksize]
+                  for i in range(0, len(commit_hashes), chunksize)]
+        references, lines = [], 0
+        for chunk_references, chunk_lines in pool.imap(f, chunks,
+                                                       stage='Cherry-picks'):
+            references += chunk_references
+            lines += chunk_lines
+
+    # key: result of HashPrefixIndex.resolve(), value: number of references
+    hits = {HashPrefixIndex.RESOLVED: 0, HashPrefixIndex.AMBIGUOUS: 0,
+            HashPrefixIndex.UNKNOWN: 0}
+    abbreviated = 0
+    for commit_hash, reference in references:
+        result, cherry = index.resolve(reference)
+        hits[result] += 1
+        if result == HashPrefixIndex.AMBIGUOUS:
+            log.info('Found cherry-pick %s <-> %s but the abbreviated hash is '
+                     'ambiguous' % (commit_hash, reference))
+            continue
+        elif result == HashPrefixIndex.UNKNOWN:
+            log.info('Found cherry-pick %s <-> %s but it is not a '
+                     'valid reference in this context'
+                     % (commit_hash, reference))
+            continue
+
+        if len(reference) < len(cherry):
+            abbreviated += 1
+
+        if commit_hash in cherries:
+            cherries[commit_hash].append((cherry, SimRating(1.0, 1.0, 1.0)))
+        else:
+            cherries[commit_hash] = [(cherry, SimRating(1.0, 1.0, 1.0))]
 
     log.info('  ↪ done. Found %d cherry-picks' % len(cherries))
+    log.info('  ↪ %d annotated lines in %d commits, %d references: %d '
+             'resolved (%d abbreviated), %d ambiguous, %d unknown' %
+             (lines, len(commit_hashes), len(references),
+              hits[HashPrefixIndex.RESOLVED], abbreviated,
+              hits[HashPrefixIndex.AMBIGUOUS], hits[HashPrefixIndex.UNKNOWN]))
     return cherries
 
 
+def load_previous_result(filename, is_mbox, eval_type):
+    """
+    Loads the evaluation result of a previous analysis for an incremental
+    analysis. Returns None if there is no suitable result. Sharded results
+    (cf. ShardedEvaluationResult) are directories.
+    """
+    if not os.path.exists(filename):
+        log.info('No previous evaluation result found, running a full '
+                 'analysis')
+        return None
+
+    previous = EvaluationResult.from_file(filename)
+    if previous.covered is None:
+        log.info('Previous evaluation result does not record its patches, '
+                 'running a full analysis')
+        return None
+
+    if previous.is_mbox != is_mbox or previous.eval_type != eval_type:
+        log.info('Previous evaluation result is of a different type, running '
+                 'a full analysis')
+        return None
+
+    return previous
+
+
+def parse_shard(value):
+    """
+    Parses a shard i/N, and returns the tuple (i-1, N)
+    """
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid shard: %s' % value)
+
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('invalid shard: %s' % value)
+
+    return index - 1, count
+
+
+def shard_filename(er_filename, index, count):
+    return '%s.shard-%d-of-%d' % (er_filename, index + 1, count)
+
+
+def filter_result(evaluation_result, new):
+    """
+    Returns only those pairs of evaluation_result that involve a patch of new
+    """
+    ret = EvaluationResult()
+    for orig, cands in evaluation_result.items():
+        cands = [(cand, rating) for cand, rating in cands
+                 if orig in new or cand in new]
+        if cands:
+            ret[orig] = cands
+    return ret
+
+
+@profiled('analyse')
 def analyse(config, argv):
     parser = argparse.ArgumentParser(prog='analyse', description='Analyse patch stacks')
 
@@ -101,6 +226,29 @@ def analyse(config, argv):
     parser.add_argument('-adi', dest='thres_adi', metavar='days', type=int,
                         default=config.thresholds.author_date_interval,
                         help='Author date interval (default: %(default)s)')
+    parser.add_argument('-ti', dest='thres_interactive', metavar='threshold',
+                        type=float, default=config.thresholds.interactive,
+                        help='Interactive threshold, only used for pruning '
+                             '(default: %(default)s)')
+    parser.add_argument('-weight', dest='weight', metavar='weight', type=float,
+                        default=config.thresholds.message_diff_weight,
+                        help='Heuristic factor for message to diff rating, '
+                             'only used for pruning (default: %(default)s)')
+    parser.add_argument('-prune', dest='prune', action='store_true',
+                        default=False,
+                        help='Skip the diff evaluation of pairs that can\'t '
+                             'reach the interactive threshold. Pruned pairs '
+                             'can\'t be reconsidered by pasta rate with lower '
+                             'thresholds')
+
+    parser.add_argument('-topk', dest='top_k', metavar='candidates', type=int,
+                        default=None,
+                        help='Only keep the best candidates of each patch in '
+                             'the evaluation result')
+    parser.add_argument('-minrating', dest='min_rating', metavar='rating',
+                        type=float, default=None,
+                        help='Drop candidates with a weighted rating below '
+                             'this rating from the evaluation result')
 
     parser.add_argument('-er', dest='er_filename', metavar='filename',
                         default=config.f_evaluation_result,
@@ -110,6 +258,53 @@ def analyse(config, argv):
                         default=1.0, help='CPU factor for parallelisation '
                                           '(default: %(default)s)')
 
+    parser.add_argument('-mh', dest='minhash_floor', metavar='jaccard',
+                        type=float, default=None,
+                        help='Use MinHash/LSH preevaluation instead of the '
+                             'file-based preevaluation. Only compare patches '
+                             'with at least this estimated Jaccard similarity '
+                             'of their diffs')
+    parser.add_argument('-mhi', dest='minhash_index', metavar='filename',
+                        default=None,
+                        help='Load and persist the MinHash index from/to this '
+                             'file. By default, the index is created per run')
+    parser.add_argument('-mhrecall', dest='minhash_recall',
+                        action='store_true', default=False,
+                        help='Report the recall of the MinHash preevaluation '
+                             'against the file-based preevaluation')
+
+    parser.add_argument('-sharded', dest='sharded', action='store_true',
+                        default=False,
+                        help='Store the evaluation result as a directory of '
+                             'shards that are written during the evaluation. '
+                             'Incremental analyses keep the format of the '
+                             'existing result')
+    parser.add_argument('-shard', dest='shard', metavar='i/N', default=None,
+                        type=parse_shard,
+                        help='Only evaluate the i-th of N shards of the '
+                             'analysis, and write the partial result to '
+                             '<result>.shard-i-of-N. Shards of several hosts '
+                             'are combined with pasta merge_results. Not '
+                             'available in succ mode')
+
+    parser.add_argument('-nocache', dest='cache', action='store_false',
+                        default=True,
+                        help='Don\'t use the persistent similarity cache')
+    parser.add_argument('-cacheage', dest='cache_age', metavar='days',
+                        type=float, default=None,
+                        help='Evict entries of the similarity cache that were '
+                             'not used within this number of days')
+    parser.add_argument('-cachesize', dest='cache_size', metavar='entries',
+                        type=int, default=None,
+                        help='Maximum number of entries of the similarity '
+                             'cache. Evicts least recently used entries')
+
+    parser.add_argument('-incremental', dest='incremental',
+                        action='store_true', default=False,
+                        help='Only evaluate patches that are not covered by '
+                             'the existing evaluation result, and merge the '
+                             'results into it. Not available in succ mode')
+
     parser.add_argument('-linux', dest='linux', action='store_true',
                         default=False,
                         help='Make a Linux kernel specific analysis')
@@ -137,6 +332,8 @@ def analyse(config, argv):
     config.thresholds.filename = args.thres_filename
     config.thresholds.diff_lines_ratio = args.thres_diff_lines
     config.thresholds.author_date_interval = args.thres_adi
+    config.thresholds.interactive = args.thres_interactive
+    config.thresholds.message_diff_weight = args.weight
 
     repo = config.repo
     mbox = config.mode == Config.Mode.MBOX
@@ -146,8 +343,29 @@ def analyse(config, argv):
         log.error('Analysis mode succ is not available in mailbox mode!')
         return -1
 
+    if args.incremental and mode == 'succ':
+        log.error('Incremental analysis is not available in succ mode!')
+        return -1
+
+    if args.shard and mode == 'succ':
+        log.error('Sharded analysis is not available in succ mode!')
+        return -1
+
+    # Hosts of a sharded analysis share the configuration of the project. Only
+    # the first shard writes to it, all other shards only write their partial
+    # result.
+    f_result = args.er_filename
+    primary = True
+    if args.shard:
+        f_result = shard_filename(args.er_filename, *args.shard)
+        primary = args.shard[0] == 0
+
     f_cluster, cluster = config.load_cluster(must_exist=False)
 
+    # All parallel stages of the analysis share a single pool of workers.
+    # Fork it early, before any commits are cached.
+    pool = WorkerPool(max(int(cpu_count() * args.cpu_factor), 1), repo)
+
     def fill_result(hashes, tag):
         for hash in hashes:
             cluster.insert_element(hash)
@@ -155,7 +373,8 @@ def analyse(config, argv):
                 cluster.mark_upstream(hash, True)
 
         # intermediate persistence
-        cluster.to_file(f_cluster)
+        if primary:
+            cluster.to_file(f_cluster)
 
     if mbox:
         log.info('Regarding mails in time window %s--%s' %
@@ -172,7 +391,7 @@ def analyse(config, argv):
             # emails. Commit cache is already loaded, so evict everything except
             # victims and then cache all victims.
             repo.cache_evict_except(victims)
-            repo.cache_commits(victims)
+            repo.cache_commits(victims, pool=pool)
 
             # we might have loaded invalid emails, so reload the victim list once
             # more. This time, include all patches from the pre-existing (partial)
@@ -183,7 +402,7 @@ def analyse(config, argv):
             # in case of an mbox analysis, we will definitely need all untagged
             # commit hashes as we need to determine the representative system for
             # both modes, rep and upstream.
-            available = repo.cache_commits(victims)
+            available = repo.cache_commits(victims, pool=pool)
             if available != victims:
                 missing = victims - available
                 log.warning('MAILBOX RESULT CONTAINS %d MESSAGES THAT ARE NOT '
@@ -212,17 +431,18 @@ def analyse(config, argv):
             log.info('Cached %d relevant mails' % len(available))
             fill_result(victims, False)
 
+    cache = None
+    if args.cache:
+        cache = SimilarityCache.from_file(config.f_similarity_cache)
+
     cherries = EvaluationResult()
 
     if mode == 'succ':
         victims = config.psd.commits_on_stacks
         fill_result(victims, False)
-        num_cpus = int(cpu_count() * args.cpu_factor)
 
         psd = config.psd
-        global _repo
         repo = config.repo
-        _repo = repo
 
         config.load_ccache_stack()
 
@@ -238,24 +458,38 @@ def analyse(config, argv):
                                     successor.commit_hashes))
 
         # cache missing commits
-        repo.cache_commits(psd.commits_on_stacks)
+        repo.cache_commits(psd.commits_on_stacks, pool=pool)
 
         cherries = find_cherries(repo,
-                                 psd.commits_on_stacks, psd.commits_on_stacks)
+                                 psd.commits_on_stacks, psd.commits_on_stacks,
+                                 pool=pool)
 
-        f = partial(_evaluate_patch_list_wrapper, config.thresholds)
+        if args.sharded:
+            evaluation_result = ShardedEvaluationResult.create(
+                args.er_filename, False, EvaluationType.PatchStack)
+        else:
+            evaluation_result = EvaluationResult(False,
+                                                 EvaluationType.PatchStack)
+
+        f = partial(_evaluate_patch_list_wrapper, config.thresholds,
+                    args.prune, args.top_k, args.min_rating,
+                    repo.commit_store(psd.commits_on_stacks))
+        # Slice the cache before the evaluation, as results are put to the
+        # cache while tasks are handed out
+        tasks = [(orig, cand,
+                  None if cache is None else
+                  cache.slice(config.thresholds, orig, cand))
+                 for orig, cand in evaluation_list]
         log.info('Starting evaluation.')
-        pool = Pool(num_cpus, maxtasksperchild=1)
-        results = pool.map(f, evaluation_list, chunksize=5)
-        pool.close()
-        pool.join()
-        log.info('  ↪ done.')
-        _repo = None
-
-        evaluation_result = EvaluationResult(False, EvaluationType.PatchStack)
-
-        for result in results:
+        for result in pool.imap(f, tasks, chunksize=5,
+                                stage='Evaluation'):
             evaluation_result.merge(result)
+            # Workers can't fill the cache of this process
+            if cache is not None:
+                for orig, cands in result.items():
+                    for cand, rating in cands:
+                        cache.put(config.thresholds, orig, cand, rating)
+        log.info('  ↪ done.')
 
     else: # mode is rep or upstream
         # iterate over similar patch list and get latest commit of patches
@@ -287,28 +521,100 @@ def analyse(config, argv):
             config.load_ccache_upstream()
 
             # cache missing commits
-            repo.cache_commits(representatives | candidates)
+            repo.cache_commits(representatives | candidates, pool=pool)
             repo.cache_evict_except(representatives | candidates)
 
-            cherries = find_cherries(repo, representatives, candidates)
+            cherries = find_cherries(repo, representatives, candidates,
+                                     pool=pool)
             type = EvaluationType.Upstream
         elif mode == 'rep':
-            repo.cache_commits(representatives)
+            repo.cache_commits(representatives, pool=pool)
             candidates = representatives
 
             if not mbox:
                 cherries = find_cherries(repo, representatives,
-                                         config.psd.commits_on_stacks)
+                                         config.psd.commits_on_stacks,
+                                         pool=pool)
 
             type = EvaluationType.PatchStack
 
+        evaluation_list = [(representatives, candidates)]
+
+        previous = None
+        if args.incremental:
+            previous = load_previous_result(args.er_filename, mbox, type)
+
+        if previous is not None:
+            everything = representatives | candidates
+            new = everything - previous.covered
+            log.info('Incremental analysis: %d of %d patches are new' %
+                     (len(new), len(everything)))
+
+            # New representatives against all candidates, and, if candidates
+            # and representatives differ, remaining representatives against
+            # new candidates
+            new_representatives = representatives & new
+            evaluation_list = [(new_representatives, candidates)]
+            if mode == 'upstream':
+                evaluation_list.append((representatives - new_representatives,
+                                        candidates & new))
+
+            cherries = filter_result(cherries, new)
+
+        minhash_index = None
+        if args.minhash_floor is not None:
+            if args.minhash_index:
+                minhash_index = MinHashIndex.from_file(args.minhash_index)
+            else:
+                minhash_index = MinHashIndex()
+
         log.info('Starting evaluation')
-        evaluation_result = evaluate_commit_list(repo, config.thresholds,
-                                                 mbox, type,
-                                                 representatives, candidates,
-                                                 parallelise=True, verbose=True,
-                                                 cpu_factor=args.cpu_factor)
+        if previous is not None and not args.shard:
+            evaluation_result = previous
+        elif args.sharded:
+            evaluation_result = ShardedEvaluationResult.create(f_result,
+                                                               mbox, type)
+        else:
+            evaluation_result = EvaluationResult(mbox, type)
+
+        # The first shard carries the previous result
+        if previous is not None and args.shard and primary:
+            evaluation_result.merge(previous)
+
+        for originals, cands in evaluation_list:
+            if not originals or not cands:
+                continue
+
+            evaluate_commit_list(repo, config.thresholds,
+                                 mbox, type,
+                                 originals, cands,
+                                 parallelise=True, verbose=True,
+                                 cpu_factor=args.cpu_factor,
+                                 minhash_index=minhash_index,
+                                 minhash_floor=args.minhash_floor,
+                                 report_recall=args.minhash_recall,
+                                 prune=args.prune,
+                                 cache=cache,
+                                 result=evaluation_result,
+                                 pool=pool,
+                                 top_k=args.top_k,
+                                 min_rating=args.min_rating,
+                                 shard=args.shard)
+        evaluation_result.covered = (evaluation_result.covered or set()) | \
+                                    representatives | candidates
         log.info('  ↪ done.')
 
-    evaluation_result.merge(cherries)
-    evaluation_result.to_file(args.er_filename)
+        if minhash_index is not None and args.minhash_index and primary:
+            minhash_index.to_file(args.minhash_index)
+
+    pool.close()
+
+    with stage('Writing result'):
+        if primary:
+            evaluation_result.merge(cherries)
+        evaluation_result.to_file(f_result)
+
+    # Several hosts must not write the shared similarity cache
+    if cache is not None and not args.shard:
+        cache.evict(args.cache_age, args.cache_size)
+        cache.to_file(config.f_similarity_cache)
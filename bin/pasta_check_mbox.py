@@ -64,7 +64,8 @@ def check_mbox(config, argv):
     _, cluster = config.load_patch_groups()
 
     range = repo.get_commithash_range(args.range[0])
-    repo.cache_commits(range)
+    # Only subjects and dates are needed
+    repo.cache_commits(range, eager=False)
 
     found = []
     not_found = []
@@ -35,6 +35,18 @@ def compare(config, argv):
                         help='Minimum diff hunk section heading similarity '
                              '(default: %(default)s)')
 
+    parser.add_argument('-nocache', dest='cache', action='store_false',
+                        default=True,
+                        help='Don\'t use the persistent similarity cache')
+    parser.add_argument('-cacheage', dest='cache_age', metavar='days',
+                        type=float, default=None,
+                        help='Evict entries of the similarity cache that were '
+                             'not used within this number of days')
+    parser.add_argument('-cachesize', dest='cache_size', metavar='entries',
+                        type=int, default=None,
+                        help='Maximum number of entries of the similarity '
+                             'cache. Evicts least recently used entries')
+
     args = parser.parse_args(argv)
 
     config.thresholds.heading = args.thres_heading
@@ -49,6 +61,10 @@ def compare(config, argv):
         show_commit(repo, commits[0])
         return
 
+    cache = None
+    if args.cache:
+        cache = SimilarityCache.from_file(config.f_similarity_cache)
+
     for i in range(len(commits)-1):
         commit_a = commits[i]
         commit_b = commits[i+1]
@@ -58,9 +74,13 @@ def compare(config, argv):
         # evaluation type plays no role in this case
         rating = evaluate_commit_list(repo, config.thresholds,
                                       False, None,
-                                      [commit_a], [commit_b])
+                                      [commit_a], [commit_b], cache=cache)
         if rating:
             print(rating[commit_a][0][1])
         else:
             print('Not related')
         getch()
+
+    if cache is not None:
+        cache.evict(args.cache_age, args.cache_size)
+        cache.to_file(config.f_similarity_cache)
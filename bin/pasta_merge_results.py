@@ -0,0 +1,118 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from pypasta import *
+from pypasta.PatchEvaluation import retain_candidates
+
+log = getLogger(__name__[-15:])
+
+
+def merge_shards(results):
+    """
+    Merges the shards of evaluation results. Fails if shards are missing or
+    contained more than once.
+    :param results: list of (filename, EvaluationResult)
+    :return: the merged EvaluationResult
+    """
+    ret = EvaluationResult()
+    # key: (digest, index), value: filename of the result that contains it
+    origin = dict()
+
+    for filename, result in results:
+        if not result.shards:
+            raise ValueError('%s is not a shard of an evaluation result' %
+                             filename)
+
+        if ret.eval_type is None:
+            ret.eval_type = result.eval_type
+            ret.is_mbox = result.is_mbox
+        elif (ret.eval_type, ret.is_mbox) != \
+             (result.eval_type, result.is_mbox):
+            raise ValueError('%s is a result of a different analysis' %
+                             filename)
+
+        for digest, (count, indices) in result.shards.items():
+            for index in indices:
+                if (digest, index) in origin:
+                    raise ValueError('Shard %d/%d is contained in %s and %s' %
+                                     (index + 1, count,
+                                      origin[digest, index], filename))
+                origin[digest, index] = filename
+
+        ret.merge(result)
+
+    for digest, (count, indices) in ret.shards.items():
+        missing = set(range(count)) - indices
+        if missing:
+            raise ValueError('Missing shards of evaluation %s: %s' %
+                             (digest[:12],
+                              ', '.join(['%d/%d' % (x + 1, count)
+                                         for x in sorted(missing)])))
+
+    # Shards mirror ratings into the candidates of other shards. Apply the
+    # retention policy to the merged candidates.
+    for orig, evaluation in ret.items():
+        if ret.retention:
+            evaluation = retain_candidates(evaluation, ret.retention)
+        evaluation.sort(key=lambda x: x[1], reverse=True)
+        ret[orig] = evaluation
+
+    # The result is complete
+    ret.shards = None
+
+    return ret
+
+
+def merge_results(config, argv):
+    parser = argparse.ArgumentParser(prog='merge_results',
+                                     description='Merge the shards of an '
+                                                 'analysis')
+
+    parser.add_argument('-er', dest='er_filename', metavar='filename',
+                        default=config.f_evaluation_result,
+                        help='Evaluation result PKL filename. Shards are '
+                             'searched next to it, unless they are given '
+                             'explicitly (default: %(default)s)')
+    parser.add_argument('shards', metavar='shard', nargs='*',
+                        help='Evaluation results of pasta analyse -shard')
+
+    args = parser.parse_args(argv)
+
+    shards = args.shards
+    if not shards:
+        shards = sorted(glob.glob(glob.escape(args.er_filename) +
+                                  '.shard-*-of-*'))
+    if not shards:
+        log.error('No shards found')
+        return -1
+
+    log.info('Merging %d shards' % len(shards))
+    results = [(filename, EvaluationResult.from_file(filename))
+               for filename in shards]
+    try:
+        result = merge_shards(results)
+    except ValueError as e:
+        log.error(str(e))
+        return -1
+
+    log.info('Writing merged evaluation result to %s' % args.er_filename)
+    result.to_file(args.er_filename)
+
+    return 0
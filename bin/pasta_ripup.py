@@ -61,6 +61,10 @@ def ripup(config, argv):
                         default=config.thresholds.author_date_interval,
                         help='Author date interval (default: %(default)s)')
 
+    parser.add_argument('-nocache', dest='cache', action='store_false',
+                        default=True,
+                        help='Don\'t use the persistent similarity cache')
+
     args = parser.parse_args(argv)
     representatives = args.reps
     repo = config.repo
@@ -76,6 +80,10 @@ def ripup(config, argv):
 
     f_cluster, cluster = config.load_cluster()
 
+    cache = None
+    if args.cache:
+        cache = SimilarityCache.from_file(config.f_similarity_cache)
+
     for representative in representatives:
         if representative not in cluster:
             log.error('Not found in any patch group: %s' % representative)
@@ -89,10 +97,14 @@ def ripup(config, argv):
                                                  elems, elems,
                                                  parallelise=False,
                                                  verbose=True,
-                                                 cpu_factor=args.cpu_factor)
+                                                 cpu_factor=args.cpu_factor,
+                                                 cache=cache)
 
         evaluation_result.load_fp(config.d_false_positives, False)
         evaluation_result.interactive_rating(repo, cluster,
                                              config.thresholds, False, True)
         evaluation_result.fp.to_file(config.d_false_positives)
         cluster.to_file(f_cluster)
+
+    if cache is not None:
+        cache.to_file(config.f_similarity_cache)
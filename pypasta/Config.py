@@ -19,6 +19,7 @@ from logging import getLogger
 
 from .Clustering import Clustering
 from .Repository import Repository
+from .Repository.Patch import Hunk
 from .PatchStack import PatchStackDefinition
 from .Util import load_commit_hashes, persist_commit_hashes, parse_date_ymd
 
@@ -156,6 +157,11 @@ class Config:
         self.f_ccache_stack = path('COMMIT_CACHE_STACK')
         self.f_ccache_upstream = path('COMMIT_CACHE_UPSTREAM')
         self.f_ccache_mbox = path('COMMIT_CACHE_MBOX')
+        self.f_similarity_cache = join(self._project_root,
+                                       pasta.get('SIMILARITY_CACHE',
+                                                 'resources/similarity-cache.pkl'))
+        # Share the lines of several loaded commit caches, cf. Hunk
+        Hunk.INTERN_ON_LOAD = bool(pasta.get('INTERN_ON_LOAD', False))
 
         self.f_characteristics = path('CHARACTERISTICS')
         self.f_characteristics_pkl = path('CHARACTERISTICS_PKL')
@@ -214,14 +220,15 @@ class Config:
     def _update_ccache(self, f_ccache, ids, desc):
         repo = self.repo
         changed = False
-        ids = set(ids)
+        # Keep the order of ids, cf. cache_commits()
+        wanted = set(ids)
         repo.clear_commit_cache()
         already_cached = repo.load_ccache(f_ccache, desc)
-        evicted = repo.cache_evict_except(ids)
+        evicted = repo.cache_evict_except(wanted)
         if len(evicted):
             changed = True
         already_cached -= evicted
-        if len(ids - already_cached):
+        if len(wanted - already_cached):
             repo.cache_commits(ids)
             changed = True
 
@@ -0,0 +1,53 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+from bisect import bisect_left
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+
+class HashPrefixIndex:
+    """
+    A sorted index of commit hashes that resolves abbreviated hashes, as they
+    are used in commit messages, to full hashes.
+    """
+    # Results of resolve()
+    RESOLVED = 'resolved'
+    AMBIGUOUS = 'ambiguous'
+    UNKNOWN = 'unknown'
+
+    def __init__(self, hashes):
+        self._hashes = sorted({x.lower() for x in hashes})
+
+    def resolve(self, prefix):
+        """
+        Resolves the (abbreviated) hash prefix.
+        :return: tuple of the result (RESOLVED, AMBIGUOUS or UNKNOWN) and the
+                 full hash, if it is unambiguous
+        """
+        prefix = prefix.lower()
+        i = bisect_left(self._hashes, prefix)
+        if i == len(self._hashes) or not self._hashes[i].startswith(prefix):
+            return HashPrefixIndex.UNKNOWN, None
+
+        if i + 1 < len(self._hashes) and \
+           self._hashes[i + 1].startswith(prefix):
+            return HashPrefixIndex.AMBIGUOUS, None
+
+        return HashPrefixIndex.RESOLVED, self._hashes[i]
+
+    def __contains__(self, hash):
+        return self.resolve(hash)[0] == HashPrefixIndex.RESOLVED
+
+    def __len__(self):
+        return len(self._hashes)
@@ -0,0 +1,217 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pickle
+import zlib
+
+from logging import getLogger
+from tqdm import tqdm
+
+# The MinHash preevaluation is optional, and only requires NumPy if it is used
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = getLogger(__name__[-15:])
+
+
+class MinHashIndex:
+    """
+    A MinHash/LSH index over the content of diffs. The index estimates the
+    Jaccard similarity of the shingled diff content of two patches, and
+    quickly finds all patches that are likely to exceed a given Jaccard
+    similarity.
+
+    Signatures consist of num_perm MinHashes and are split into bands of equal
+    size. Two patches are considered as candidates, if they share at least one
+    band.
+    """
+    # Signatures consist of the lower 32 bits of universal hashes
+    # (a * x + b) mod PRIME of the shingles, with the Mersenne prime 2^61 - 1
+    PRIME = (1 << 61) - 1
+    MAX_HASH = (1 << 32) - 1
+
+    # Number of consecutive tokens of a shingle
+    SHINGLE_SIZE = 3
+
+    def __init__(self, num_perm=128, bands=64, seed=1):
+        if np is None:
+            raise ImportError('The MinHash preevaluation requires NumPy')
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 1 << 32, num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 1 << 32, num_perm, dtype=np.uint64)
+
+        # key: identifier, value: signature
+        self.signatures = dict()
+        # one dictionary per band that maps band hashes to identifiers
+        self.buckets = [dict() for _ in range(bands)]
+
+    @staticmethod
+    def shingles(diff):
+        """
+        Returns the set of hashed shingles of a diff. Shingles are formed
+        from the tokens of insertions and deletions of all hunks. Additionally,
+        every touched file forms a shingle, as patches that only move files
+        come without any hunks.
+        """
+        def crc(shingle):
+            return zlib.crc32(shingle.encode('utf-8', 'ignore'))
+
+        ret = set()
+
+        for filenames, patch in diff.patches.items():
+            ret.add(crc('@' + ' '.join(filenames)))
+            for hunk in patch.hunks.values():
+                for prefix, lines in (('+', hunk.insertions),
+                                      ('-', hunk.deletions)):
+                    tokens = ' '.join(lines).split()
+                    if not tokens:
+                        continue
+
+                    size = min(MinHashIndex.SHINGLE_SIZE, len(tokens))
+                    for i in range(len(tokens) - size + 1):
+                        ret.add(crc(prefix + ' '.join(tokens[i:i+size])))
+
+        return ret
+
+    def signature(self, shingles):
+        """
+        Calculates the MinHash signature of a set of hashed shingles. Returns
+        None for empty sets.
+        """
+        if not shingles:
+            return None
+
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        hashes = (MinHashIndex._mulmod(values, self._a) + self._b) % \
+                 np.uint64(MinHashIndex.PRIME)
+        hashes &= np.uint64(MinHashIndex.MAX_HASH)
+
+        return hashes.min(axis=0).astype(np.uint32)
+
+    @staticmethod
+    def _mulmod(values, coefficients):
+        """
+        Returns the matrix (value * coefficient) mod PRIME of all values and
+        coefficients. Values have up to 64 bits, coefficients up to 32 bits.
+        The products are split, so that no intermediate result exceeds 64 bits.
+        """
+        prime = np.uint64(MinHashIndex.PRIME)
+        low_mask = np.uint64(MinHashIndex.MAX_HASH)
+
+        values = values % prime
+        high = (values >> np.uint64(32))[:, None]
+        low = (values & low_mask)[:, None]
+
+        # value * a = high * a * 2^32 + low * a, and 2^61 = 1 mod PRIME
+        upper = high * coefficients
+        upper = (upper >> np.uint64(29)) + \
+                ((upper & np.uint64((1 << 29) - 1)) << np.uint64(32))
+
+        return (upper % prime + (low * coefficients) % prime) % prime
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band*self.rows:(band+1)*self.rows].tobytes()
+
+    def insert(self, identifier, diff):
+        if identifier in self.signatures:
+            return
+
+        signature = self.signature(self.shingles(diff))
+        self.signatures[identifier] = signature
+        if signature is None:
+            return
+
+        for band, key in self._band_keys(signature):
+            bucket = self.buckets[band]
+            if key not in bucket:
+                bucket[key] = set()
+            bucket[key].add(identifier)
+
+    def update(self, repo, identifiers):
+        """
+        Inserts all identifiers that are not yet part of the index. The
+        commits must be reachable via repo.
+        """
+        missing = set(identifiers) - self.signatures.keys()
+        if len(missing) == 0:
+            return
+
+        log.info('Adding %d patches to the MinHash index' % len(missing))
+        for identifier in tqdm(missing):
+            self.insert(identifier, repo[identifier].diff)
+
+    def jaccard(self, left, right):
+        """
+        Returns the estimated Jaccard similarity of two indexed patches
+        """
+        l_sig = self.signatures[left]
+        r_sig = self.signatures[right]
+        if l_sig is None or r_sig is None:
+            return 0.0
+
+        return np.count_nonzero(l_sig == r_sig) / self.num_perm
+
+    def query(self, identifier, floor):
+        """
+        Returns all indexed patches whose estimated Jaccard similarity to
+        identifier is at least floor.
+        """
+        signature = self.signatures[identifier]
+        if signature is None:
+            return set()
+
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates |= self.buckets[band].get(key, set())
+        candidates.discard(identifier)
+
+        return {x for x in candidates if self.jaccard(identifier, x) >= floor}
+
+    def __contains__(self, identifier):
+        return identifier in self.signatures
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def to_file(self, filename):
+        log.info('Writing MinHash index with %d patches' % len(self))
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_file(filename, must_exist=False, **kwargs):
+        """
+        Loads the index from filename. If filename does not exist and
+        must_exist is False, a new, empty index will be returned, created with
+        kwargs.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                ret = pickle.load(f)
+            log.info('Loaded MinHash index with %d patches' % len(ret))
+            return ret
+        except FileNotFoundError:
+            if must_exist:
+                raise
+            log.info('MinHash index %s not found, creating a new one' %
+                     filename)
+            return MinHashIndex(**kwargs)
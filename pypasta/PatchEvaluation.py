@@ -10,18 +10,43 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 import functools
+import hashlib
+import heapq
 import os
 import pickle
+import shutil
 
+from array import array
+from bisect import bisect_left
+from collections import Counter
 from enum import Enum
 from fuzzywuzzy import fuzz
 from multiprocessing import Pool, cpu_count
 from statistics import mean
 
+from .Profiler import profiled, stage
+from .Repository import CommitStore
+from .Scheduler import Scheduler
 from .Util import *
 
+# The batch evaluation rates one patch against many patches with a single call
+# into RapidFuzz, and requires NumPy. It uses the same scorer as fuzzywuzzy,
+# and is therefore only available if python-Levenshtein is backed by RapidFuzz
+# (python-Levenshtein >= 0.20). Otherwise, we fall back to pairwise evaluation.
+try:
+    import numpy as np
+    from Levenshtein import ratio as levenshtein_ratio
+    from rapidfuzz.process import cdist, cpdist
+    batch_available = hasattr(levenshtein_ratio, '_RF_Scorer')
+except ImportError:
+    batch_available = False
+
 log = getLogger(__name__[-15:])
 
+# Version of the rating of patches. Increment it whenever ratings change, as
+# this invalidates persistent similarity caches.
+SCORER_VERSION = 1
+
 # We need this global variable, as pygit2 Repository objects are not pickleable
 _tmp_repo = None
 
@@ -120,15 +145,23 @@ class FalsePositives:
 
 
 class SimRating:
-    def __init__(self, msg, diff, diff_lines_ratio):
+    # Default for SimRatings of evaluation results that were created before
+    # pruning was available
+    _pruned = False
+
+    def __init__(self, msg, diff, diff_lines_ratio, pruned=False):
         """
         :param msg: Message rating
         :param diff: Diff rating
         :param diff_lines_ratio: Ratio of number of lines shorter diff to longer diff
+        :param pruned: The evaluation stopped early, as the pair could not
+               reach the interactive threshold. The diff rating (and possibly
+               the message rating) was not calculated and is 0.
         """
         self._msg = msg
         self._diff = diff
         self._diff_lines_ratio = diff_lines_ratio
+        self._pruned = pruned
 
     @property
     def msg(self):
@@ -142,6 +175,10 @@ class SimRating:
     def diff_lines_ratio(self):
         return self._diff_lines_ratio
 
+    @property
+    def pruned(self):
+        return self._pruned
+
     def __lt__(self, other):
         return self.msg + self.diff < other.msg + other.diff
 
@@ -149,7 +186,10 @@ class SimRating:
         return self.msg == other.msg and self.diff == other.diff and self.diff_lines_ratio == other.diff_lines_ratio
 
     def __str__(self):
-        return '%3.2f message and %3.2f diff, diff lines ratio: %3.2f' % (self.msg, self.diff, self.diff_lines_ratio)
+        ret = '%3.2f message and %3.2f diff, diff lines ratio: %3.2f' % (self.msg, self.diff, self.diff_lines_ratio)
+        if self.pruned:
+            ret += ' (pruned)'
+        return ret
 
 
 class EvaluationResult(dict):
@@ -157,6 +197,18 @@ class EvaluationResult(dict):
     An evaluation is a dictionary with a commit hash as key,
     and a list of tuples (hash, SimRating) as value.
     """
+    # Default for evaluation results that were created before pruning was
+    # available
+    prune_thresholds = None
+    # Default for evaluation results that don't record their coverage
+    covered = None
+    # Default for evaluation results that were created before retention
+    # policies were available
+    retention = None
+    # Default for evaluation results that were created before sharding was
+    # available
+    shards = None
+
     def __init__(self, is_mbox = None, eval_type = None, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
         self.eval_type = eval_type
@@ -164,20 +216,74 @@ class EvaluationResult(dict):
         self._false_positives = []
         self.fp = None
 
+        # If the evaluation was pruned, this is a tuple of the interactive
+        # threshold and the message_diff_weight that were used for pruning
+        self.prune_thresholds = None
+
+        # Set of all commit hashes resp. Message-IDs that were part of the
+        # evaluation, either as original or as candidate
+        self.covered = None
+
+        # If candidates were dropped during the evaluation, this is the
+        # retention policy, cf. retain_candidates()
+        self.retention = None
+
+        # If the result only contains shards of evaluations, this is a
+        # dictionary with the digest of the evaluation (cf. shard_evaluation())
+        # as key, and a tuple of the number of shards and the set of contained
+        # shards as value
+        self.shards = None
+
     def merge(self, other):
+        if other.prune_thresholds:
+            self.prune_thresholds = other.prune_thresholds
+
+        if other.retention:
+            self.retention = other.retention
+
+        for digest, (count, indices) in (other.shards or {}).items():
+            self.add_shards(digest, count, indices)
+
+        if other.covered is not None:
+            self.covered = (self.covered or set()) | other.covered
+
+        for key, value in other.items():
+            self.append(key, value)
+
+    def append(self, orig, evaluation):
+        """
+        Adds the list of (hash, SimRating) tuples evaluation to orig
+        """
         # Check if this key already exists in the check_list
         # if yes, then append to the list
-        for key, value in other.items():
-            if key in self:
-                self[key] += value
-            else:
-                self[key] = value
+        if orig in self:
+            self[orig] += evaluation
+        else:
+            self[orig] = evaluation
+
+    def add_shards(self, digest, count, indices):
+        """
+        Records that the result contains the shards indices of count shards
+        of the evaluation digest
+        """
+        if self.shards is None:
+            self.shards = dict()
+
+        known, contained = self.shards.get(digest, (count, set()))
+        if known != count:
+            raise ValueError('Evaluation %s was split into %d and %d shards' %
+                             (digest, known, count))
+        self.shards[digest] = count, contained | set(indices)
 
     def to_file(self, filename):
         # Sort by SimRating
         for i in self.keys():
             self[i].sort(key=lambda x: x[1], reverse=True)
 
+        # Replace sharded results of previous runs
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+
         with open(filename, 'wb') as f:
             pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
 
@@ -187,14 +293,34 @@ class EvaluationResult(dict):
 
     @staticmethod
     def from_file(filename, fp_directory=None, fp_must_exist=False):
+        """
+        Loads an evaluation result. If filename is a directory, the result is
+        sharded and will be loaded lazily (cf. ShardedEvaluationResult).
+        """
         log.info('Loading evaluation result')
-        with open(filename, 'rb') as f:
-            ret = pickle.load(f)
+        if os.path.isdir(filename):
+            ret = ShardedEvaluationResult.open(filename)
+        else:
+            with open(filename, 'rb') as f:
+                ret = pickle.load(f)
         log.info('  ↪ done')
         ret.load_fp(fp_directory, fp_must_exist)
 
         return ret
 
+    def rating_order(self):
+        """
+        Yields all originals with at least one candidate, together with their
+        candidates. Originals are ordered by their best SimRating, ascending.
+        """
+        # Convert the dictionary of evaluation results to a sorted list,
+        # sorted by its SimRating. First, get all items, but filter for
+        # relevant items with at leas one comparison result
+        sorted_er = [x for x in self.items() if len(x[1])]
+        sorted_er.sort(key=lambda x: x[1][0][1])
+
+        return iter(sorted_er)
+
     def interactive_rating(self, repo, clustering, thresholds,
                            respect_commitdate, enable_pager):
         already_false_positive = 0
@@ -206,27 +332,52 @@ class EvaluationResult(dict):
         skipped = 0
         skipped_by_dlr = 0
         skipped_by_commit_date = 0
+        skipped_by_pruning = 0
+
+        if self.prune_thresholds:
+            interactive, weight = self.prune_thresholds
+            if thresholds.interactive < interactive or \
+               thresholds.message_diff_weight != weight:
+                log.warning('The evaluation result was pruned for an '
+                            'interactive threshold of %0.2f and a weight of '
+                            '%0.2f. Pruned pairs might reach the current '
+                            'thresholds, but will be skipped. Rerun the '
+                            'analysis to consider them.' %
+                            (interactive, weight))
+
+        if self.retention:
+            top_k, min_rating, weight = self.retention
+            if top_k is not None:
+                log.info('The evaluation result only contains the best %d '
+                         'candidates of each patch' % top_k)
+            if min_rating is not None and \
+               (thresholds.interactive < min_rating or
+                thresholds.message_diff_weight != weight):
+                log.warning('The evaluation result dropped candidates below '
+                            'a rating of %0.2f with a weight of %0.2f. '
+                            'Dropped candidates might reach the current '
+                            'thresholds. Rerun the analysis to consider '
+                            'them.' % (min_rating, weight))
 
         def accept(orig, cand):
             clustering.insert(orig, cand)
             if self.eval_type == EvaluationType.Upstream:
                 clustering.mark_upstream(cand)
 
-        # Convert the dictionary of evaluation results to a sorted list,
-        # sorted by its SimRating. First, get all items, but filter for
-        # relevant items with at leas one comparison result
-        sorted_er = [x for x in self.items() if len(x[1])]
-        sorted_er.sort(key=lambda x: x[1][0][1])
-
         filtered_er = dict()
 
-        for orig_commit_hash, candidates in sorted_er:
+        for orig_commit_hash, candidates in self.rating_order():
             for cand_commit_hash, sim_rating in candidates:
                 # this comparison is the first one, as it holds in most cases
                 if sim_rating.diff_lines_ratio < thresholds.diff_lines_ratio:
                     skipped_by_dlr += 1
                     continue
 
+                # pruned pairs can't reach the interactive threshold
+                if sim_rating.pruned:
+                    skipped_by_pruning += 1
+                    continue
+
                 # unlikely, but this comparison is cheap
                 if cand_commit_hash == orig_commit_hash:
                     continue
@@ -277,6 +428,9 @@ class EvaluationResult(dict):
         log.info(' Skipped due to false positive mark: %d'
                  % already_false_positive)
         log.info(' Skipped by diff length ratio mismatch: %d' % skipped_by_dlr)
+        if self.prune_thresholds:
+            log.info(' Skipped due to pruning during analysis: %d'
+                     % skipped_by_pruning)
         if respect_commitdate:
             log.info(' Skipped by commit date mismatch: %d'
                      % skipped_by_commit_date)
@@ -331,7 +485,199 @@ class EvaluationResult(dict):
         log.info(' Skipped: %d' % skipped)
 
 
-def best_string_mapping(threshold, left_list, right_list):
+class ShardedEvaluationResult(EvaluationResult):
+    """
+    An EvaluationResult that lives in a directory. Evaluations are appended to
+    the result as soon as they are produced, and are only loaded on access.
+    Neither writing nor reading requires the whole result in memory, and the
+    result of an interrupted analysis remains readable.
+
+    The directory contains the metadata of the result and several append-only
+    shards. A shard is a sequence of pickled (original, evaluation) records.
+    An original may occur in several records, its evaluation is the
+    concatenation of all of them.
+    """
+    META = 'meta.pkl'
+    SHARD_PREFIX = 'shard-'
+
+    def __init__(self, directory, is_mbox=None, eval_type=None):
+        EvaluationResult.__init__(self, is_mbox, eval_type)
+        self.directory = directory
+
+        # key: original
+        # value: list of (shard filename, offset) of all records of original
+        self._locations = dict()
+        # key: original, value: best SimRating of original
+        self._best = dict()
+
+        # Shard this process appends to
+        self._shard = None
+        # key: shard filename, value: file object for reading
+        self._readers = dict()
+
+    @staticmethod
+    def create(directory, is_mbox, eval_type):
+        """
+        Creates a new, empty sharded result. Replaces any existing result.
+        """
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        elif os.path.exists(directory):
+            os.remove(directory)
+        os.makedirs(directory)
+
+        ret = ShardedEvaluationResult(directory, is_mbox, eval_type)
+        ret.write_meta()
+        return ret
+
+    @staticmethod
+    def open(directory):
+        with open(os.path.join(directory, ShardedEvaluationResult.META),
+                  'rb') as f:
+            meta = pickle.load(f)
+
+        ret = ShardedEvaluationResult(directory, meta['is_mbox'],
+                                      meta['eval_type'])
+        ret.prune_thresholds = meta['prune_thresholds']
+        ret.covered = meta['covered']
+        ret.retention = meta.get('retention')
+        ret.shards = meta.get('shards')
+
+        # Index all records. This reads all shards once, but only keeps the
+        # locations of the records in memory.
+        shards = sorted(x for x in os.listdir(directory)
+                        if x.startswith(ShardedEvaluationResult.SHARD_PREFIX))
+        for shard in shards:
+            filename = os.path.join(directory, shard)
+            with open(filename, 'rb') as f:
+                while True:
+                    offset = f.tell()
+                    try:
+                        orig, evaluation = pickle.load(f)
+                    except EOFError:
+                        break
+                    except pickle.UnpicklingError:
+                        log.warning('Truncated record in %s' % filename)
+                        break
+                    ret._index(orig, evaluation, filename, offset)
+
+        return ret
+
+    def _index(self, orig, evaluation, filename, offset):
+        if orig not in self._locations:
+            self._locations[orig] = list()
+        self._locations[orig].append((filename, offset))
+
+        if evaluation:
+            best = max(rating for _, rating in evaluation)
+            if orig not in self._best or self._best[orig] < best:
+                self._best[orig] = best
+
+    def write_meta(self):
+        meta = {'is_mbox': self.is_mbox,
+                'eval_type': self.eval_type,
+                'prune_thresholds': self.prune_thresholds,
+                'retention': self.retention,
+                'shards': self.shards,
+                'covered': self.covered}
+        with open(os.path.join(self.directory, ShardedEvaluationResult.META),
+                  'wb') as f:
+            pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+
+    def append(self, orig, evaluation):
+        if self._shard is None:
+            filename = '%s%d.pkl' % (ShardedEvaluationResult.SHARD_PREFIX,
+                                     os.getpid())
+            self._shard = open(os.path.join(self.directory, filename), 'ab')
+
+        offset = self._shard.tell()
+        pickle.dump((orig, evaluation), self._shard, pickle.HIGHEST_PROTOCOL)
+        self._shard.flush()
+
+        self._index(orig, evaluation, self._shard.name, offset)
+
+    def to_file(self, filename):
+        """
+        All evaluations are already on disk, only the metadata is missing.
+        Copies the result, if filename is not the directory of this result.
+        """
+        if os.path.abspath(filename) != os.path.abspath(self.directory):
+            copy = EvaluationResult(self.is_mbox, self.eval_type, self.items())
+            copy.prune_thresholds = self.prune_thresholds
+            copy.covered = self.covered
+            copy.retention = self.retention
+            copy.shards = self.shards
+            copy.to_file(filename)
+            return
+
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+        self.write_meta()
+
+    def __getitem__(self, orig):
+        if orig not in self._locations:
+            raise KeyError(orig)
+
+        evaluation = list()
+        for filename, offset in self._locations[orig]:
+            if filename not in self._readers:
+                self._readers[filename] = open(filename, 'rb')
+            f = self._readers[filename]
+            f.seek(offset)
+            evaluation += pickle.load(f)[1]
+
+        evaluation.sort(key=lambda x: x[1], reverse=True)
+        return evaluation
+
+    def get(self, orig, default=None):
+        if orig not in self._locations:
+            return default
+        return self[orig]
+
+    def __contains__(self, orig):
+        return orig in self._locations
+
+    def __iter__(self):
+        return iter(self._locations)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def keys(self):
+        return self._locations.keys()
+
+    def values(self):
+        for orig in self._locations:
+            yield self[orig]
+
+    def items(self):
+        for orig in self._locations:
+            yield orig, self[orig]
+
+    def rating_order(self):
+        origs = list(self._best.keys())
+        origs.sort(key=lambda x: self._best[x])
+
+        for orig in origs:
+            yield orig, self[orig]
+
+
+def rate_keys(left, right):
+    """
+    Rates two keys that were created by token_sort_key(). This is equivalent to
+    fuzz.token_sort_ratio() on the original objects.
+    """
+    # This check is _required_ as fuzzywuzzy currently contains a bug that
+    # does misevaluations in case of equivalence. See
+    # https://github.com/seatgeek/fuzzywuzzy/issues/196
+    if left == right:
+        return 100
+    return fuzz.ratio(left, right)
+
+
+def best_string_mapping(threshold, left_list, right_list, left_keys=None,
+                        right_keys=None):
     """
     This function tries to find the closest mapping with the best weight of two lists of strings.
     Example:
@@ -347,6 +693,9 @@ def best_string_mapping(threshold, left_list, right_list):
 
     As a[{0,1,2}] == b[{0,1,2}], those values will automatically be mapped. Additionally, a[2] will also be mapped to
     b[3], if the threshold is low enough (cf. 0.5).
+
+    left_keys and right_keys optionally map the elements of the lists to their
+    precomputed token_sort_key(). Missing keys will be computed on demand.
     """
 
     if threshold >= 1.0:
@@ -356,79 +705,142 @@ def best_string_mapping(threshold, left_list, right_list):
                 ret.add((left, left))
         return ret
 
-    def injective_map(ll, rl, inverse_result=False):
-        ret = dict()
-        for l_entry in ll:
-            for r_entry in rl:
-                # This check is _required_ as fuzzywuzzy currently contains a
-                # bug that does misevaluations in case of equivalence. See
-                # https://github.com/seatgeek/fuzzywuzzy/issues/196
-                if l_entry == r_entry:
-                    sim = 1
-                else:
-                    sim = fuzz.token_sort_ratio(l_entry, r_entry) / 100
+    def get_keys(entries, keys):
+        keys = keys or {}
+        return {x: keys[x] if x in keys else token_sort_key(x)
+                for x in entries}
 
-                if sim < threshold:
-                    continue
+    left_keys = get_keys(left_list, left_keys)
+    right_keys = get_keys(right_list, right_keys)
 
-                if l_entry in ret:
-                    _, old_sim = ret[l_entry]
-                    if sim < old_sim:
+    def injective_map(ll, rl, l_keys, r_keys, inverse_result=False):
+        """
+        Maps every entry of ll to the last entry of rl with the best
+        similarity above the threshold. Entries with equal keys are resolved
+        by hashing; only the residue takes the fuzzy path.
+        """
+        rl = list(rl)
+        r_keys = [r_keys[r_entry] for r_entry in rl]
+
+        # key: token sort key, value: last position in rl with that key
+        exact = {key: index for index, key in enumerate(r_keys)}
+
+        ret = set()
+        for l_entry in ll:
+            l_key = l_keys[l_entry]
+            best = exact.get(l_key)
+
+            if best is not None:
+                # The entry is already mapped with a similarity of 1. Only
+                # later entries with a different key that also round to 100
+                # could replace it.
+                for index in range(best + 1, len(rl)):
+                    r_key = r_keys[index]
+                    if r_key == l_key or \
+                       rating_upper_bound(l_key, r_key) < 100:
+                        continue
+                    if rate_keys(l_key, r_key) == 100:
+                        best = index
+            else:
+                best_sim = 0
+                for index, r_key in enumerate(r_keys):
+                    if rating_upper_bound(l_key, r_key) / 100 < threshold:
                         continue
 
-                ret[l_entry] = r_entry, sim
-        return {(r, l) if inverse_result else (l, r) for l, (r, _) in ret.items()}
+                    sim = rate_keys(l_key, r_key) / 100
+                    if sim < threshold or sim < best_sim:
+                        continue
 
-    return injective_map(left_list, right_list) | injective_map(right_list, left_list, True)
+                    best = index
+                    best_sim = sim
 
+            if best is None:
+                continue
 
-def rate_diffs(thresholds, l_diff, r_diff):
-    filename_compare = best_string_mapping(thresholds.filename, l_diff.patches.keys(), r_diff.patches.keys())
-    levenshteins = []
+            r_entry = rl[best]
+            ret.add((r_entry, l_entry) if inverse_result else
+                    (l_entry, r_entry))
+        return ret
 
-    def compare_hunks(left, right):
-        # This case happens for example, if both hunks remove empty newlines
-        # This check is _required_ as fuzzywuzzy currently contains a bug that
-        # does misevaluations in case of equivalence. See
-        # https://github.com/seatgeek/fuzzywuzzy/issues/196
-        if left == right:
-            return 100
-        return fuzz.token_sort_ratio(left, right)
+    return injective_map(left_list, right_list, left_keys, right_keys) | \
+           injective_map(right_list, left_list, right_keys, left_keys, True)
 
-    def get_patch(diff, filename):
-        patch = diff.patches[filename]
-        return patch.similarity, patch.hunks
+
+def diff_comparisons(thresholds, l_diff, r_diff):
+    """
+    Determines all comparisons that are required to rate two diffs. Returns a
+    list with an entry for each pair of mapped files. Each entry is a tuple of
+    a fixed rating of the file pair (or None), and a list of pairs of hunk keys
+    that need to be rated.
+    """
+    # Identical diffs map each file to itself, if no two files can be confused
+    if l_diff.fingerprint == r_diff.fingerprint and l_diff.unambiguous:
+        filename_compare = [(x, x) for x in l_diff.patches.keys()]
+    else:
+        filename_compare = best_string_mapping(thresholds.filename,
+                                               l_diff.patches.keys(),
+                                               r_diff.patches.keys(),
+                                               l_diff.filename_keys,
+                                               r_diff.filename_keys)
+    comparisons = []
 
     for l_filename, r_filename in filename_compare:
-        l_similarity, l_hunks = get_patch(l_diff, l_filename)
-        r_similarity, r_hunks = get_patch(r_diff, r_filename)
+        l_patch = l_diff.patches[l_filename]
+        r_patch = r_diff.patches[r_filename]
+        l_similarity, l_hunks = l_patch.similarity, l_patch.hunks
+        r_similarity, r_hunks = r_patch.similarity, r_patch.hunks
 
         # This is the case, if the file was moved without any further change. No
         # further comparisons required.
         if l_similarity == 100 and r_similarity == 100:
-            levenshteins.append(100)
+            comparisons.append((100, []))
             continue
 
+        fixed = None
         if l_similarity == r_similarity and l_similarity != 0:
-            levenshteins.append(100)
+            fixed = 100
+
+        # Identical files: each hunk maps to itself and is rated with 100
+        if l_patch.fingerprint == r_patch.fingerprint and l_patch.unambiguous:
+            comparisons.append((fixed, []))
+            if any(hunk.insertions or hunk.deletions
+                   for hunk in l_hunks.values()):
+                comparisons.append((100, []))
+            continue
 
-        levenshtein = []
+        pairs = []
         hunk_compare = best_string_mapping(thresholds.heading,
-                                           l_hunks.keys(), r_hunks.keys())
+                                           l_hunks.keys(), r_hunks.keys(),
+                                           l_patch.heading_keys,
+                                           r_patch.heading_keys)
 
         for l_hunk_heading, r_hunk_heading in hunk_compare:
             lhunk = l_hunks[l_hunk_heading]
             rhunk = r_hunks[r_hunk_heading]
 
             if lhunk.deletions and rhunk.deletions:
-                levenshtein.append(compare_hunks(lhunk.deletions,
-                                                 rhunk.deletions))
+                pairs.append((lhunk.deletions_key, rhunk.deletions_key))
             if lhunk.insertions and rhunk.insertions:
-                levenshtein.append(compare_hunks(lhunk.insertions,
-                                                 rhunk.insertions))
+                pairs.append((lhunk.insertions_key, rhunk.insertions_key))
+
+        comparisons.append((fixed, pairs))
 
-        if levenshtein:
-            levenshteins.append(mean(levenshtein))
+    return comparisons
+
+
+def rate_comparisons(comparisons, ratings):
+    """
+    Calculates the diff rating from the result of diff_comparisons().
+    :param ratings: iterator over the ratings of all pairs of hunk keys, in
+                    the order of comparisons
+    """
+    levenshteins = []
+
+    for fixed, pairs in comparisons:
+        if fixed is not None:
+            levenshteins.append(fixed)
+        if pairs:
+            levenshteins.append(mean([next(ratings) for _ in pairs]))
 
     if not levenshteins:
         levenshteins = [0]
@@ -438,7 +850,47 @@ def rate_diffs(thresholds, l_diff, r_diff):
     return diff_rating
 
 
-def evaluate_patch_pair(thresholds, lhs, rhs):
+def rate_diffs(thresholds, l_diff, r_diff):
+    if l_diff.fingerprint == r_diff.fingerprint and l_diff.perfect:
+        return 1.0
+
+    comparisons = diff_comparisons(thresholds, l_diff, r_diff)
+    ratings = (rate_keys(l, r) for _, pairs in comparisons for l, r in pairs)
+
+    return rate_comparisons(comparisons, ratings)
+
+
+def rating_upper_bound(left, right):
+    """
+    Returns an upper bound of rate_keys(left, right) that only depends on the
+    lengths of the keys. At most all characters of the shorter key match.
+    """
+    if left == right:
+        return 100
+
+    lensum = len(left) + len(right)
+    return -(-200 * min(len(left), len(right)) // lensum)
+
+
+def can_reach_interactive(thresholds, msg_rating):
+    """
+    Checks if a pair with message rating msg_rating can reach the interactive
+    threshold, assuming the best possible diff rating. Works element-wise on
+    NumPy arrays.
+    """
+    return thresholds.message_diff_weight * msg_rating + \
+           (1-thresholds.message_diff_weight) * 1 >= thresholds.interactive
+
+
+def evaluate_patch_pair(thresholds, lhs, rhs, prune=False):
+    """
+    Rates two patches.
+    :param lhs: tuple of the message key (cf. MessageDiff.message_key) and the
+                diff of the left-hand side
+    :param rhs: same as lhs for the right-hand side
+    :param prune: Stop early and return a pruned SimRating if the pair can't
+                  reach thresholds.interactive
+    """
     left_message, left_diff = lhs
     right_message, right_diff = rhs
 
@@ -453,8 +905,16 @@ def evaluate_patch_pair(thresholds, lhs, rhs):
     if diff_lines_ratio < thresholds.diff_lines_ratio:
         return SimRating(0, 0, diff_lines_ratio)
 
+    if prune:
+        msg_bound = rating_upper_bound(left_message, right_message) / 100
+        if not can_reach_interactive(thresholds, msg_bound):
+            return SimRating(0, 0, diff_lines_ratio, pruned=True)
+
     # get rating of message
-    msg_rating = fuzz.token_sort_ratio(left_message, right_message) / 100
+    msg_rating = rate_keys(left_message, right_message) / 100
+
+    if prune and not can_reach_interactive(thresholds, msg_rating):
+        return SimRating(msg_rating, 0, diff_lines_ratio, pruned=True)
 
     # get rating of diff
     diff_rating = rate_diffs(thresholds, left_diff, right_diff)
@@ -462,51 +922,419 @@ def evaluate_patch_pair(thresholds, lhs, rhs):
     return SimRating(msg_rating, diff_rating, diff_lines_ratio)
 
 
-def evaluate_commit_pair(repo, thresholds, lhs_commit_hash, rhs_commit_hash):
+def evaluate_commit_pair(repo, thresholds, lhs_commit_hash, rhs_commit_hash,
+                         prune=False, cache=None):
+    """
+    :param cache: optional SimilarityCache that is consulted and filled
+    """
     # Return identical similarity for equivalent commits
     if lhs_commit_hash == rhs_commit_hash:
         return SimRating(1, 1, 1)
 
+    if cache is not None:
+        rating = cache.get(thresholds, lhs_commit_hash, rhs_commit_hash)
+        if rating is not None:
+            return rating
+
     lhs = repo[lhs_commit_hash]
     rhs = repo[rhs_commit_hash]
 
-    lhs = lhs.message, lhs.diff
-    rhs = rhs.message, rhs.diff
+    lhs = lhs.message_key, lhs.diff
+    rhs = rhs.message_key, rhs.diff
 
-    return evaluate_patch_pair(thresholds, lhs, rhs)
+    rating = evaluate_patch_pair(thresholds, lhs, rhs, prune)
+    if cache is not None:
+        cache.put(thresholds, lhs_commit_hash, rhs_commit_hash, rating)
 
+    return rating
 
-def _evaluate_commit_pair_helper(thresholds, lhs_commit_hash, rhs_commit_hash):
-    return evaluate_commit_pair(_tmp_repo, thresholds, lhs_commit_hash, rhs_commit_hash)
 
+def _batch_rate_keys(left, right):
+    """
+    Element-wise rate_keys() on two lists of keys. Returns a list of ratings.
+    """
+    if not left:
+        return []
+
+    ratings = cpdist(left, right, scorer=levenshtein_ratio, dtype=np.float64)
+    return np.rint(100 * ratings).astype(np.int64).tolist()
+
+
+def evaluate_patch_batch(thresholds, lhs, rhs, prune=False):
+    """
+    Rates one patch against a list of patches. This is equivalent to calling
+    evaluate_patch_pair() for each element of rhs, but all message and all hunk
+    ratings are calculated with a single call.
+    :param lhs: tuple of the message key and the diff of the left-hand side
+    :param rhs: list of tuples of message keys and diffs
+    :param prune: see evaluate_patch_pair()
+    :return: NumPy arrays of message ratings, diff ratings, diff lines ratios
+             and pruned flags
+    """
+    left_message, left_diff = lhs
+    num = len(rhs)
+
+    lines = np.array([diff.lines for _, diff in rhs], dtype=np.int64)
+    max_lines = np.maximum(lines, left_diff.lines)
+    min_lines = np.minimum(lines, left_diff.lines)
+
+    # prevent division by zero
+    diff_lines_ratio = np.ones(num)
+    np.divide(min_lines, max_lines, out=diff_lines_ratio,
+              where=max_lines != 0)
+
+    msg_rating = np.zeros(num)
+    diff_rating = np.zeros(num)
+    pruned = np.zeros(num, dtype=bool)
+
+    def prune_unreachable(relevant, msg_ratings):
+        reachable = can_reach_interactive(thresholds, msg_ratings)
+        pruned[relevant[~reachable]] = True
+        return relevant[reachable]
+
+    relevant = np.flatnonzero(diff_lines_ratio >= thresholds.diff_lines_ratio)
+
+    if prune:
+        bounds = [rating_upper_bound(left_message, rhs[i][0])
+                  for i in relevant]
+        bounds = np.array(bounds, dtype=np.int64) / 100
+        relevant = prune_unreachable(relevant, bounds)
+
+    if len(relevant) == 0:
+        return msg_rating, diff_rating, diff_lines_ratio, pruned
+
+    # get ratings of messages
+    messages = [rhs[i][0] for i in relevant]
+    with stage('Message scoring', len(messages)):
+        ratings = cdist([left_message], messages, scorer=levenshtein_ratio,
+                        dtype=np.float64)[0]
+        msg_rating[relevant] = np.rint(100 * ratings) / 100
+
+    if prune:
+        relevant = prune_unreachable(relevant, msg_rating[relevant])
+
+    # get ratings of diffs
+    with stage('Hunk scoring') as s:
+        comparisons = [diff_comparisons(thresholds, left_diff, rhs[i][1])
+                       for i in relevant]
+        pairs = [pair for comparison in comparisons
+                 for _, hunk_pairs in comparison for pair in hunk_pairs]
+        ratings = iter(_batch_rate_keys([l for l, _ in pairs],
+                                        [r for _, r in pairs]))
+        for i, comparison in zip(relevant, comparisons):
+            diff_rating[i] = rate_comparisons(comparison, ratings)
+        s.items = len(pairs)
+
+    return msg_rating, diff_rating, diff_lines_ratio, pruned
+
+
+def evaluate_commit_batch(repo, thresholds, lhs_commit_hash, rhs_commit_hashes,
+                          prune=False):
+    """
+    Batch variant of evaluate_commit_pair(). Returns a list of SimRatings, one
+    for each element of rhs_commit_hashes.
+    """
+    with stage('Commit loading', len(rhs_commit_hashes) + 1):
+        lhs = repo[lhs_commit_hash]
+        rhs = [repo[x] for x in rhs_commit_hashes]
+
+    lhs = lhs.message_key, lhs.diff
+    rhs = [(x.message_key, x.diff) for x in rhs]
+
+    msg, diff, diff_lines_ratio, pruned = \
+        evaluate_patch_batch(thresholds, lhs, rhs, prune)
+    ratings = [SimRating(*x) for x in zip(msg.tolist(), diff.tolist(),
+                                          diff_lines_ratio.tolist(),
+                                          pruned.tolist())]
+
+    # Return identical similarity for equivalent commits
+    return [SimRating(1, 1, 1) if rhs_commit_hash == lhs_commit_hash else rating
+            for rhs_commit_hash, rating in zip(rhs_commit_hashes, ratings)]
+
+
+def _evaluate_commit_pair_helper(thresholds, prune, lhs_commit_hash,
+                                 rhs_commit_hash):
+    return evaluate_commit_pair(_tmp_repo, thresholds, lhs_commit_hash,
+                                rhs_commit_hash, prune)
+
+
+def retain_candidates(evaluation, retention):
+    """
+    Applies a retention policy to a list of (hash, SimRating) tuples.
+    :param retention: tuple (top_k, min_rating, weight). Candidates with a
+           rating below min_rating are dropped, and at most top_k candidates
+           with the best ratings are kept. Ratings are weighted by weight, as
+           in interactive_rating(). top_k and min_rating may be None.
+           Candidates with equal ratings are kept in the order of their
+           hashes, such that the result does not depend on the order of
+           evaluation.
+    """
+    top_k, min_rating, weight = retention
+
+    def rating(x):
+        return weight * x[1].msg + (1 - weight) * x[1].diff
+
+    def order(x):
+        return rating(x), x[0]
+
+    if min_rating is not None:
+        evaluation = [x for x in evaluation if rating(x) >= min_rating]
+
+    if top_k is not None and len(evaluation) > top_k:
+        evaluation = heapq.nlargest(top_k, evaluation, key=order)
+
+    return evaluation
+
+
+def _evaluation_helper(thresholds, l_r, verbose=False, prune=False,
+                       f_commit_store=None, retention=None):
+    # Workers attach to the shared commit store, and stay attached
+    if f_commit_store:
+        global _tmp_repo
+        _tmp_repo = CommitStore.attach(f_commit_store)
 
-def _evaluation_helper(thresholds, l_r, verbose=False):
     left, right = l_r
+    right = list(right)
     if verbose:
         print('Comparing 1 patch against %d patches' % len(right))
 
-    f = functools.partial(_evaluate_commit_pair_helper, thresholds, left)
-    results = list(map(f, right))
+    if batch_available:
+        results = evaluate_commit_batch(_tmp_repo, thresholds, left, right,
+                                        prune)
+    else:
+        f = functools.partial(_evaluate_commit_pair_helper, thresholds, prune,
+                              left)
+        with stage('Pairwise scoring', len(right)):
+            results = list(map(f, right))
     results = list(zip(right, results))
 
+    # Only return candidates that could matter
+    if retention:
+        results = retain_candidates(results, retention)
+
     # sort SimRating
     results.sort(key=lambda x: x[1], reverse=True)
 
-    return left, results
+    return left, results, len(right)
+
 
+def evaluation_cost(repo, task):
+    """
+    Estimates the cost of _evaluation_helper() for task. The cost of rating a
+    pair grows with the size of both diffs.
+    """
+    left, right = task
+    lines = repo[left].diff.lines
+    return sum([1 + lines + repo[x].diff.lines for x in right])
 
-def preevaluate_filenames(thresholds, right_files, left_file):
+
+def split_evaluation(task, parts):
+    """
+    Splits the candidates of task into at most parts tasks. Each task has at
+    least one candidate.
+    """
+    left, right = task
+    right = sorted(right)
+    parts = min(parts, len(right))
+    return [(left, right[i::parts]) for i in range(parts)]
+
+
+def shard_evaluation(repo, thresholds, folded_result, shard):
+    """
+    Splits the evaluation of folded_result into shards of similar estimated
+    cost (cf. evaluation_cost()). The split only depends on folded_result, so
+    that independent hosts that run the same analysis agree on it.
+    :param shard: tuple of the index of the shard, and the number of shards
+    :return: the representatives of the shard index, and a digest of the
+             evaluation
+    """
+    index, count = shard
+
+    digest = hashlib.sha1()
+    digest.update(repr(sorted(vars(thresholds).items())).encode())
+    for representative in sorted(folded_result.keys()):
+        cands = sorted(folded_result[representative])
+        digest.update(('%s %s\n' % (representative, ' '.join(cands))).encode())
+
+    # Assign the most expensive representatives first, always to the shard
+    # with the lowest load
+    tasks = [(evaluation_cost(repo, task), task[0])
+             for task in folded_result.items()]
+    tasks.sort(key=lambda x: (-x[0], x[1]))
+
+    loads = [(0, i) for i in range(count)]
+    ret = set()
+    for cost, representative in tasks:
+        load, i = heapq.heappop(loads)
+        if i == index:
+            ret.add(representative)
+        heapq.heappush(loads, (load + cost, i))
+
+    return ret, digest.hexdigest()
+
+
+class FilenameIndex:
+    """
+    Trigram index of filenames. Returns all filenames that reach a threshold
+    of similarity (cf. fuzz.token_sort_ratio()) to a given filename without
+    rating every pair of filenames.
+
+    The LCS of two keys limits their rating. A filename can only reach the
+    threshold if its length is in range, and, for a given length, if it shares
+    a minimum number of trigrams with the other key: each character that is
+    not part of the LCS breaks at most three trigrams. If a key must share T of
+    its N trigrams, it must share at least one of any N - T + 1 trigrams, so it
+    suffices to look up the rarest ones. Candidates are verified with
+    rate_keys().
+    """
+    Q = 3
+
+    def __init__(self, threshold, filenames):
+        self.threshold = threshold
+        # Minimum rate_keys() rating that reaches the threshold
+        self._min_rating = next(x for x in range(101) if x / 100 >= threshold)
+
+        # key: token_sort_key() of a filename, value: list of filenames
+        self._filenames = {}
+        for filename in filenames:
+            self._filenames.setdefault(token_sort_key(filename),
+                                       []).append(filename)
+        self._keys = list(self._filenames.keys())
+
+        # key: length, value: ids of all keys of that length
+        self._lengths = {}
+        # key: (length, trigram), value: ids of all keys of that length that
+        # contain the trigram
+        self._postings = {}
+        for id, key in enumerate(self._keys):
+            self._lengths.setdefault(len(key), []).append(id)
+            for trigram in FilenameIndex.trigrams(key):
+                self._postings.setdefault((len(key), trigram), []).append(id)
+
+    @staticmethod
+    def trigrams(key):
+        q = FilenameIndex.Q
+        return Counter(key[i:i + q] for i in range(len(key) - q + 1))
+
+    def _min_lcs(self, left, right):
+        # rate_keys() rounds 200 * LCS / lensum to the next integer
+        return (2 * self._min_rating - 1) * (left + right) // 400
+
+    def _min_trigrams(self, left, right, lcs):
+        q = FilenameIndex.Q
+        return max(left - q + 1 - q * (left - lcs) - (q - 1) * (right - lcs),
+                   right - q + 1 - q * (right - lcs) - (q - 1) * (left - lcs))
+
+    def candidates(self, key):
+        """
+        Returns the ids of all keys that may reach the threshold
+        """
+        ret = []
+        trigrams = None
+        for length, ids in self._lengths.items():
+            lcs = self._min_lcs(len(key), length)
+            if lcs > min(len(key), length):
+                continue
+
+            required = self._min_trigrams(len(key), length, lcs)
+            if required <= 0:
+                ret += ids
+                continue
+
+            if trigrams is None:
+                trigrams = FilenameIndex.trigrams(key)
+
+            postings = [(self._postings.get((length, trigram), []), count)
+                        for trigram, count in trigrams.items()]
+            postings.sort(key=lambda x: len(x[0]))
+
+            # Look up the rarest trigrams until the remaining ones can't
+            # make up the required number of trigrams
+            prefix = sum(trigrams.values()) - required + 1
+            candidates = set()
+            for ids, count in postings:
+                candidates.update(ids)
+                prefix -= count
+                if prefix <= 0:
+                    break
+            ret += candidates
+
+        return ret
+
+    def query(self, filename):
+        """
+        Returns all filenames with a similarity of at least the threshold to
+        filename. This is equivalent to comparing filename against all
+        filenames with fuzz.token_sort_ratio().
+        """
+        key = token_sort_key(filename)
+        keys = [self._keys[id] for id in self.candidates(key)]
+
+        if batch_available:
+            ratings = _batch_rate_keys([key] * len(keys), keys)
+        else:
+            ratings = [rate_keys(key, x) for x in keys]
+
+        ret = []
+        for right, rating in zip(keys, ratings):
+            if rating / 100 < self.threshold:
+                continue
+            ret += self._filenames[right]
+        return ret
+
+
+def preevaluate_filenames(filename_index, left_file):
     # We won't enter preevaluate_filenames, if tf >= 1.0
-    candidates = []
-    for right_file in right_files:
-        sim = fuzz.token_sort_ratio(left_file, right_file) / 100
-        if sim < thresholds.filename:
-            continue
-        candidates.append(right_file)
-    return left_file, candidates
+    return left_file, filename_index.query(left_file)
 
 
-def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, parallelise=True):
+class AuthorDateIndex:
+    """
+    Sorted author dates of patches, bucketed, e.g., by affected files. Answers
+    which patches of a bucket were authored within a number of days of a date
+    by bisection, without touching the patches of the bucket.
+    """
+    DAY = 24 * 60 * 60 * 1000 * 1000
+
+    def __init__(self, repo, buckets):
+        """
+        :param buckets: dictionary, key: bucket, value: hashes of the bucket
+        """
+        self._repo = repo
+        # key: hash, value: author date in microseconds since the epoch
+        self._dates = {}
+        # key: bucket, value: tuple of sorted dates and their hashes
+        self._buckets = {}
+
+        for bucket, hashes in buckets.items():
+            entries = sorted((self.date(hash), hash) for hash in hashes)
+            self._buckets[bucket] = array('q', [x[0] for x in entries]), \
+                                    [x[1] for x in entries]
+
+    def date(self, hash):
+        if hash not in self._dates:
+            date = self._repo[hash].author.date
+            self._dates[hash] = datetime_to_epoch_us(date)
+        return self._dates[hash]
+
+    def query(self, bucket, hash, interval):
+        """
+        Returns all patches of bucket with an author date distance of less than
+        interval days to the author date of hash. Equivalent to filtering by
+        abs((x.author.date - date).days) < interval, where timedelta.days
+        rounds down.
+        """
+        dates, hashes = self._buckets[bucket]
+        date = self.date(hash)
+        lo = bisect_left(dates, date - (interval - 1) * AuthorDateIndex.DAY)
+        hi = bisect_left(dates, date + interval * AuthorDateIndex.DAY)
+        return hashes[lo:hi]
+
+
+@profiled('preevaluate_commit_list',
+          items=lambda result: sum([len(x) for x in result.values()]))
+def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes,
+                            parallelise=True, pool=None):
     cpu_factor = 0.5
 
     # Create two dictionaries - one for mails, one for commits that map
@@ -528,53 +1356,69 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
     right_files = file_commit_map(right_hashes)
     right_filenames = list(right_files.keys())
 
+    # respect author_date_interval. Only consider patches for comparison that
+    # have at max a temporal author_date distance of author_date_interval days
+    interval = thresholds.author_date_interval
+    date_index = None
+    if interval:
+        date_index = AuthorDateIndex(repo, right_files)
+
+    def candidates(left_hash, files):
+        ret = set()
+        for file in files:
+            if date_index is not None:
+                ret.update(date_index.query(file, left_hash, interval))
+            else:
+                ret |= right_files[file]
+        return ret
+
     preeval_result = {}
     # Use the quick path if tf >= 1.0
     if thresholds.filename >= 1.0:
         log.info('Creating preevaluation result...')
         for left_hash in left_hashes:
-            this_right_hashes = set()
-            affects = repo[left_hash].diff.affected
-            for affect in affects:
-                if affect in right_files:
-                    this_right_hashes |= right_files[affect]
+            affects = repo[left_hash].diff.affected & right_files.keys()
+            this_right_hashes = candidates(left_hash, affects)
             # no comparisons against each other
             this_right_hashes.discard(left_hash)
 
-            # respect author_date_interval. Only consider patches for
-            # comparison that have at max a temporal author_date
-            # distance of author_date_interval days
-            left_author_date = repo[left_hash].author.date
-            if thresholds.author_date_interval:
-               this_right_hashes = {
-                    x for x in this_right_hashes
-                    if abs((repo[x].author.date - left_author_date).days) <
-                       thresholds.author_date_interval}
             if len(this_right_hashes):
                 preeval_result[left_hash] = this_right_hashes
         return preeval_result
 
     # Otherwise, take the long path...
     log.info('Mapping filenames...')
-    f = functools.partial(preevaluate_filenames, thresholds, right_filenames)
-    if parallelise:
+    with stage('Filename index', len(right_filenames)):
+        filename_index = FilenameIndex(thresholds.filename, right_filenames)
+    f = functools.partial(preevaluate_filenames, filename_index)
+    # The index is sent along with every chunk. Queries are cheap, so use few,
+    # large chunks.
+    chunks = lambda processes: max(len(left_filenames) // (processes * 4), 1)
+    if pool is not None:
+        filename_mapping = pool.map(f, left_filenames,
+                                    chunksize=chunks(pool.processes),
+                                    stage='Filename mapping')
+    elif parallelise:
         processes = int(cpu_count() * cpu_factor)
         p = Pool(processes=processes, maxtasksperchild=1)
-        filename_mapping = p.map(f, left_filenames, chunksize=5)
+        filename_mapping = p.map(f, left_filenames,
+                                 chunksize=chunks(processes))
         p.close()
         p.join()
     else:
-        filename_mapping = list(map(f, left_filenames))
+        with stage('Filename mapping', len(left_filenames)):
+            filename_mapping = list(map(f, left_filenames))
 
     log.info('Creating preevaluation result...')
     for left_file, dsts in filename_mapping:
         left_hashes = left_files[left_file]
-        right_hashes = set()
-        for right_file in dsts:
-            right_hashes |= set(right_files[right_file])
+        if date_index is None:
+            right_hashes = candidates(None, dsts)
 
         for left_hash in left_hashes:
             left = repo[left_hash]
+            if date_index is not None:
+                right_hashes = candidates(left_hash, dsts)
 
             if left_hash not in preeval_result:
                 preeval_result[left_hash] = set()
@@ -587,9 +1431,6 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
                 # skip if we're comparing a patch against itself
                 if left_hash == right_hash:
                     continue
-                # check if this wasn't already inserted the other way round
-                if right_hash in preeval_result and left_hash in preeval_result[right_hash]:
-                    continue
                 # insert result
                 preeval_result[left_hash].add(right_hash)
 
@@ -599,10 +1440,126 @@ def preevaluate_commit_list(repo, thresholds, left_hashes, right_hashes, paralle
     return preeval_result
 
 
+@profiled('preevaluate_minhash',
+          items=lambda result: sum([len(x) for x in result.values()]))
+def preevaluate_minhash(repo, thresholds, minhash_index, floor,
+                        left_hashes, right_hashes):
+    """
+    Alternative to preevaluate_commit_list(): Only pairs patches with an
+    estimated Jaccard similarity of their diff content of at least floor.
+    """
+    log.info('Creating MinHash preevaluation result...')
+    minhash_index.update(repo, set(left_hashes) | set(right_hashes))
+    right_hashes = set(right_hashes)
+
+    # respect author_date_interval, same as preevaluate_commit_list()
+    interval = thresholds.author_date_interval
+    date_index = None
+    if interval:
+        date_index = AuthorDateIndex(repo, {None: right_hashes})
+
+    preeval_result = {}
+    for left_hash in left_hashes:
+        this_right_hashes = minhash_index.query(left_hash, floor) & \
+                            right_hashes
+        if date_index is not None and this_right_hashes:
+            this_right_hashes &= set(date_index.query(None, left_hash,
+                                                      interval))
+        if len(this_right_hashes):
+            preeval_result[left_hash] = this_right_hashes
+
+    return preeval_result
+
+
+def canonicalise_pairs(preeval_result, hashes):
+    """
+    Returns the preevaluation result with each unordered pair of hashes only
+    once. Pairs of two hashes are oriented from the smaller to the larger hash,
+    independent of the order of the preevaluation.
+    :param hashes: hashes that are originals and candidates at the same time
+    """
+    ret = {}
+    for left, rights in preeval_result.items():
+        for right in rights:
+            l, r = left, right
+            if l in hashes and r in hashes and r < l:
+                l, r = r, l
+            if l not in ret:
+                ret[l] = set()
+            ret[l].add(r)
+
+    return ret
+
+
+def fold_identical_patches(repo, preeval_result):
+    """
+    Pre-clusters patches with identical message keys and diff fingerprints,
+    such as resends of the same patch. Those patches are rated identically,
+    so it suffices to evaluate one representative of each group.
+    :return: the folded preevaluation result, and a function that maps a pair
+             of hashes to the pair of the folded result that carries its rating
+    """
+    hashes = set(preeval_result.keys()).union(*preeval_result.values())
+
+    # key: message key and diff fingerprint, value: representative
+    groups = {}
+    # key: hash, value: representative of its group
+    representatives = {}
+    # key: representative, value: another member of its group
+    twins = {}
+    for hash in sorted(hashes):
+        patch = repo[hash]
+        key = patch.message_key, patch.diff.fingerprint
+        representative = groups.setdefault(key, hash)
+        representatives[hash] = representative
+        if representative != hash and representative not in twins:
+            twins[representative] = hash
+
+    def fold(left, right):
+        left = representatives[left]
+        right = representatives[right]
+        # Two different members of the same group: Their rating is not the
+        # rating of the representative against itself.
+        if left == right:
+            right = twins[left]
+        return left, right
+
+    folded_result = {}
+    for left, rights in preeval_result.items():
+        for right in rights:
+            l, r = fold(left, right)
+            if l not in folded_result:
+                folded_result[l] = set()
+            folded_result[l].add(r)
+
+    return folded_result, fold
+
+
+def preevaluation_recall(reference, result):
+    """
+    Returns the fraction of unordered pairs of the preevaluation result
+    reference that are also contained in result.
+    """
+    def pairs(preeval_result):
+        return {frozenset((left, right))
+                for left, rights in preeval_result.items()
+                for right in rights}
+
+    reference = pairs(reference)
+    if not reference:
+        return 1.0
+
+    return len(reference & pairs(result)) / len(reference)
+
+
+@profiled('evaluate_commit_list')
 def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
                          original_hashes, candidate_hashes,
                          parallelise=False, verbose=False,
-                         cpu_factor=1):
+                         cpu_factor=1, minhash_index=None, minhash_floor=0.2,
+                         report_recall=False, prune=False, cache=None,
+                         result=None, pool=None, top_k=None,
+                         min_rating=None, shard=None):
     """
     Evaluates two list of original and candidate hashes against each other
     :param repo: repository
@@ -614,6 +1571,35 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
     :param parallelise: Parallelise evaluation
     :param verbose: Verbose output
     :param cpu_factor: number of threads to be spawned is the number of CPUs*cpu_factor
+    :param minhash_index: if set, use the MinHashIndex for preevaluation
+           instead of the file-based preevaluation
+    :param minhash_floor: minimum estimated Jaccard similarity of the diffs of
+           two patches for the MinHash preevaluation
+    :param report_recall: additionally run the file-based preevaluation and
+           report the recall of the MinHash preevaluation
+    :param prune: skip the expensive parts of the evaluation of pairs that
+           can't reach thresholds.interactive, and mark them as pruned
+    :param cache: optional SimilarityCache. Only pairs that are not cached
+           will be evaluated, and their ratings will be added to the cache.
+    :param result: EvaluationResult that receives the results. By default, a
+           new EvaluationResult is created.
+    :param pool: WorkerPool that runs all parallel stages. If not set, and if
+           parallelise is set, stages create their own pools.
+    :param top_k: only keep the top_k candidates with the best ratings of each
+           original
+    :param min_rating: drop candidates with a rating below min_rating. Ratings
+           are weighted by thresholds.message_diff_weight.
+    :param shard: tuple of the index of a shard and the number of shards. If
+           set, only evaluate this shard of the evaluation, cf.
+           shard_evaluation(). The result only contains the originals and
+           mirrored candidates of the shard.
+
+    Patches that are originals and candidates at the same time, e.g., in rep
+    mode, are only evaluated once per pair. The rating is added to both
+    directions of the result. min_rating does not depend on the direction,
+    and is applied as soon as ratings are available. top_k is applied per
+    original once all of its ratings are known, i.e., after unfolding
+    identical patches and after mirroring.
     :return: a dictionary with originals as keys and a list of potential candidates as value
     """
 
@@ -624,7 +1610,10 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
         log.info('%s reduced %d comparisons down to %d. (factor: %0.2f)' %
                  (name, original, pre, factor))
 
-    if cpu_factor == 0:
+    if pool is not None:
+        parallelise = True
+        processes = pool.processes
+    elif cpu_factor == 0:
         parallelise = False
     else:
         processes = int(cpu_count() * cpu_factor)
@@ -632,36 +1621,229 @@ def evaluate_commit_list(repo, thresholds, is_mbox, eval_type,
     log.info('Comparing %d patches against %d patches'
           % (len(original_hashes), len(candidate_hashes)))
 
+    retention = None
+    if top_k is not None or min_rating is not None:
+        retention = top_k, min_rating, thresholds.message_diff_weight
+
+    # Workers only drop ratings below min_rating. The top_k candidates of a
+    # representative aren't necessarily the top_k candidates of the patches
+    # it represents, or of the mirrored direction of its pairs.
+    rating_floor = None
+    if min_rating is not None:
+        rating_floor = None, min_rating, thresholds.message_diff_weight
+
     # Bind thresholds to evaluation
-    f_eval = functools.partial(_evaluation_helper, thresholds, verbose=verbose)
+    f_eval = functools.partial(_evaluation_helper, thresholds, verbose=verbose,
+                               prune=prune, retention=rating_floor)
 
     if verbose:
         log.info('Running preevaluation...')
-    preeval_result = preevaluate_commit_list(repo, thresholds,
-                                             original_hashes, candidate_hashes,
-                                             parallelise=parallelise)
+    if minhash_index is None:
+        preeval_result = preevaluate_commit_list(repo, thresholds,
+                                                 original_hashes,
+                                                 candidate_hashes,
+                                                 parallelise=parallelise,
+                                                 pool=pool)
+    else:
+        preeval_result = preevaluate_minhash(repo, thresholds, minhash_index,
+                                             minhash_floor, original_hashes,
+                                             candidate_hashes)
+        if report_recall:
+            reference = preevaluate_commit_list(repo, thresholds,
+                                                original_hashes,
+                                                candidate_hashes,
+                                                parallelise=parallelise,
+                                                pool=pool)
+            log.info('MinHash preevaluation recall against file-based '
+                     'preevaluation: %0.4f' %
+                     preevaluation_recall(reference, preeval_result))
     if verbose:
         log.info('  ↪ done')
 
+    # Patches that are compared against each other. Their pairs are unordered.
+    mirrored = set(original_hashes) & set(candidate_hashes)
     original_comparisons = len(original_hashes)*len(candidate_hashes)
+    if mirrored:
+        # No patch is compared against itself, and each pair only once
+        original_comparisons -= len(mirrored) * (len(mirrored) + 1) // 2
+
+        ordered_comparisons = sum([len(x) for x in preeval_result.values()])
+        preeval_result = canonicalise_pairs(preeval_result, mirrored)
+
     preeval_comparisons = sum([len(x) for x in preeval_result.values()])
+    if mirrored:
+        print_reduction('Unordered pairs', ordered_comparisons,
+                        preeval_comparisons)
     print_reduction('Preevaluation', original_comparisons, preeval_comparisons)
 
+    with stage('Pre-clustering', preeval_comparisons):
+        folded_result, fold = fold_identical_patches(repo, preeval_result)
+    folded_comparisons = sum([len(x) for x in folded_result.values()])
+    print_reduction('Pre-clustering', preeval_comparisons, folded_comparisons)
+
+    # Representatives of this shard
+    shard_representatives = None
+    if shard is not None:
+        shard_representatives, digest = \
+            shard_evaluation(repo, thresholds, folded_result, shard)
+        folded_result = {representative: cands for representative, cands
+                         in folded_result.items()
+                         if representative in shard_representatives}
+        shard_comparisons = sum([len(x) for x in folded_result.values()])
+        print_reduction('Shard %d/%d' % (shard[0] + 1, shard[1]),
+                        folded_comparisons, shard_comparisons)
+        folded_comparisons = shard_comparisons
+
+    # key: (orig, cand) of the folded result, value: SimRating
+    cached = {}
+    if cache is not None:
+        for orig, cands in folded_result.items():
+            for cand in cands:
+                rating = cache.get(thresholds, orig, cand)
+                if rating is not None:
+                    cached[orig, cand] = rating
+
+        folded_result = {orig: {cand for cand in cands
+                                if (orig, cand) not in cached}
+                         for orig, cands in folded_result.items()}
+        folded_result = {orig: cands for orig, cands in folded_result.items()
+                         if cands}
+        print_reduction('Similarity cache', folded_comparisons,
+                        folded_comparisons - len(cached))
+
+    # key: representative, value: originals that it represents
+    members = {}
+    for orig, cands in preeval_result.items():
+        representative, _ = fold(orig, next(iter(cands)))
+        if shard_representatives is not None and \
+           representative not in shard_representatives:
+            continue
+        if representative not in members:
+            members[representative] = []
+        members[representative].append(orig)
+
+    retval = result
+    if retval is None:
+        retval = EvaluationResult(is_mbox, eval_type)
+    retval.covered = (retval.covered or set()) | set(original_hashes) | \
+                     set(candidate_hashes)
+    if prune:
+        retval.prune_thresholds = thresholds.interactive, \
+                                  thresholds.message_diff_weight
+    if retention:
+        retval.retention = retention
+    if shard is not None:
+        retval.add_shards(digest, shard[1], [shard[0]])
+
+    # Unfolds the results of a representative and adds them to retval. All
+    # results of a representative are ready at the same time, as it is the
+    # left-hand side of all folded pairs of its members.
+    def unfold(representative, ratings):
+        for orig in members.pop(representative):
+            evaluation = []
+            for cand in preeval_result[orig]:
+                pair = fold(orig, cand)
+                if pair in ratings:
+                    rating = ratings[pair]
+                elif pair in cached:
+                    rating = cached[pair]
+                else:
+                    # dropped by the worker, below min_rating
+                    continue
+                evaluation.append((cand, rating))
+            if rating_floor:
+                evaluation = retain_candidates(evaluation, rating_floor)
+
+            if orig in mirrored:
+                for cand, rating in evaluation:
+                    if cand in mirrored:
+                        mirrors.setdefault(cand, []).append((orig, rating))
+                # The retention policy applies to both directions, and
+                # mirrored ratings of orig are only complete at the end
+                if retention:
+                    mirrors.setdefault(orig, []).extend(evaluation)
+                    continue
+
+            if retention:
+                evaluation = retain_candidates(evaluation, retention)
+
+            evaluation.sort(key=lambda x: x[1], reverse=True)
+            retval.append(orig, evaluation)
+
+    # key: candidate, value: mirrored ratings of candidate. They are added to
+    # the result at the end, to avoid lots of small appends.
+    mirrors = {}
+
+    # Representatives that only consist of cached pairs
+    for representative in set(members.keys()) - folded_result.keys():
+        unfold(representative, {})
+
     global _tmp_repo
-    _tmp_repo = repo
 
-    retval = EvaluationResult(is_mbox, eval_type)
     if parallelise:
-        p = Pool(processes=processes, maxtasksperchild=1)
-        result = p.map(f_eval, preeval_result.items(), chunksize=50)
-        p.close()
-        p.join()
+        # Workers attach to a shared commit store, so they don't need to be
+        # respawned to drop the pages of the commit cache they touched.
+        needed = set(folded_result.keys()).union(*folded_result.values())
+        f_eval = functools.partial(f_eval,
+                                   f_commit_store=repo.commit_store(needed))
+
+        scheduler = Scheduler(processes,
+                              functools.partial(evaluation_cost, repo),
+                              split_evaluation)
+        if pool is None:
+            p = Pool(processes=processes)
+            results = scheduler.imap(p, f_eval, folded_result.items())
+        else:
+            results = scheduler.imap(pool, f_eval, folded_result.items(),
+                                     stage='Evaluation')
     else:
-        result = list(map(f_eval, preeval_result.items()))
+        _tmp_repo = repo
+        results = map(f_eval, folded_result.items())
+
+    # The scheduler might split representatives into several tasks
+    # key: representative, value: ratings of the finished tasks
+    partial_ratings = {}
+    # key: representative, value: number of candidates without rating
+    outstanding = {representative: len(cands)
+                   for representative, cands in folded_result.items()}
+
+    # Results are consumed as soon as they are produced, so that they can be
+    # persisted early, e.g., by a ShardedEvaluationResult
+    for representative, evaluation, evaluated in results:
+        # Tasks without candidates must not unfold a representative twice
+        if representative not in outstanding and not evaluated:
+            continue
+
+        ratings = partial_ratings.pop(representative, {})
+        ratings.update({(representative, cand): rating
+                        for cand, rating in evaluation})
+
+        outstanding[representative] -= evaluated
+        if outstanding[representative]:
+            partial_ratings[representative] = ratings
+            continue
+        del outstanding[representative]
+
+        if cache is not None:
+            for (orig, cand), rating in ratings.items():
+                cache.put(thresholds, orig, cand, rating)
+        unfold(representative, ratings)
+
+    if parallelise:
+        if pool is None:
+            p.close()
+            p.join()
+        scheduler.report()
 
     _tmp_repo = None
 
-    for orig, evaluation in result:
-        retval[orig] = evaluation
+    for cand, evaluation in mirrors.items():
+        if retention:
+            evaluation = retain_candidates(evaluation, retention)
+        evaluation.sort(key=lambda x: x[1], reverse=True)
+        retval.append(cand, evaluation)
+
+    if cache is not None:
+        cache.log_stats()
 
     return retval
@@ -0,0 +1,220 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import functools
+import json
+import os
+import resource
+import time
+
+from contextlib import contextmanager
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+# The Profiler of this process, if profiling is enabled, cf. enable()
+_profiler = None
+# PID of the process that enabled profiling
+_parent = None
+
+
+class Stage:
+    """
+    A running stage. Code that is profiled may set the number of items the
+    stage processed.
+    """
+    __slots__ = ['items']
+
+    def __init__(self, items):
+        self.items = items
+
+
+def _peak_rss():
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak RSS and processed items of named stages.
+    Worker processes record their own stages, and send them to the parent
+    along with the results of their tasks (cf. WorkerPool), where they are
+    aggregated.
+    """
+    # Consecutive tasks of a worker that are less than TRACE_GAP seconds apart
+    # are merged into one trace event
+    TRACE_GAP = 0.01
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.begin = time.time()
+
+        # key: stage name
+        # value: dictionary of calls, items, wall and CPU time, peak RSS, and
+        #        the processes that ran the stage
+        self.stages = dict()
+
+        # Complete events of the Chrome trace format
+        self._events = list()
+        # key: (name, pid), value: last trace event of a worker stage
+        self._open = dict()
+
+    def add(self, name, pid, calls, items, wall, cpu, rss):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = {'calls': 0, 'items': 0, 'wall': 0.0, 'cpu': 0.0,
+                     'peak_rss': 0, 'processes': set()}
+            self.stages[name] = stage
+
+        stage['calls'] += calls
+        stage['items'] += items
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['peak_rss'] = max(stage['peak_rss'], rss)
+        stage['processes'].add(pid)
+
+    def _trace(self, name, pid, begin, end, args):
+        self._events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': pid,
+                             'ts': (begin - self.begin) * 1e6,
+                             'dur': (end - begin) * 1e6, 'args': args})
+
+    @contextmanager
+    def stage(self, name, items=0):
+        stage = Stage(items)
+        begin = time.time()
+        cpu = time.process_time()
+        try:
+            yield stage
+        finally:
+            end = time.time()
+            cpu = time.process_time() - cpu
+            rss = _peak_rss()
+            self.add(name, self.pid, 1, stage.items, end - begin, cpu, rss)
+            # Workers only report aggregated stages
+            if self.pid == _parent:
+                self._trace(name, self.pid, begin, end,
+                            {'items': stage.items, 'cpu': cpu})
+
+    def drain(self):
+        """
+        Returns and forgets the stages that were recorded so far, and the peak
+        RSS of this process
+        """
+        stages = [(name, x['calls'], x['items'], x['wall'], x['cpu'],
+                   x['peak_rss']) for name, x in self.stages.items()]
+        self.stages.clear()
+        return _peak_rss(), stages
+
+    def merge(self, name, pid, begin, end, cpu, rss, stages):
+        """
+        Adds a task of the worker pid that ran from begin to end as part of the
+        stage name, and all stages the worker recorded during the task
+        """
+        self.add(name, pid, 1, 1, end - begin, cpu, rss)
+        for stage in stages:
+            self.add(stage[0], pid, *stage[1:])
+
+        event = self._open.get((name, pid))
+        if event and begin - self.begin - (event['ts'] + event['dur']) / 1e6 < \
+           Profiler.TRACE_GAP:
+            event['dur'] = (end - self.begin) * 1e6 - event['ts']
+            event['args']['tasks'] += 1
+            return
+
+        self._trace(name, pid, begin, end, {'tasks': 1})
+        self._open[name, pid] = self._events[-1]
+
+    def report(self):
+        log.info('Profile:')
+        for name, stage in self.stages.items():
+            log.info(' %s: %d calls, %d items, %0.2fs wall time, %0.2fs CPU '
+                     'time, peak RSS %0.1f MiB, %d processes' %
+                     (name, stage['calls'], stage['items'], stage['wall'],
+                      stage['cpu'], stage['peak_rss'] / 2**20,
+                      len(stage['processes'])))
+
+    def to_file(self, filename):
+        """
+        Writes the aggregated stages to filename.json, and the trace to
+        filename.trace.json. The trace can be opened in chrome://tracing or
+        other trace viewers.
+        """
+        stages = dict()
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, processes=len(stage['processes']))
+
+        report = {'wall': time.time() - self.begin,
+                  'peak_rss': _peak_rss(),
+                  'stages': stages}
+        with open(filename + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                     'args': {'name': 'main' if pid == _parent else
+                                      'worker %d' % pid}}
+                    for pid in {event['pid'] for event in self._events}]
+        with open(filename + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': metadata + self._events,
+                       'displayTimeUnit': 'ms'}, f)
+
+        log.info('Wrote profile to %s.json and %s.trace.json' %
+                 (filename, filename))
+
+
+def enable():
+    global _profiler, _parent
+    _parent = os.getpid()
+    _profiler = Profiler()
+
+
+def profiler():
+    """
+    Returns the Profiler of this process, or None if profiling is disabled.
+    Forked workers start with an empty Profiler.
+    """
+    global _profiler
+    if _profiler is not None and _profiler.pid != os.getpid():
+        _profiler = Profiler()
+    return _profiler
+
+
+@contextmanager
+def stage(name, items=0):
+    """
+    Profiles the enclosed code as stage name. Does nothing, if profiling is
+    disabled.
+    """
+    p = profiler()
+    if p is None:
+        yield Stage(items)
+        return
+
+    with p.stage(name, items) as s:
+        yield s
+
+
+def profiled(name, items=None):
+    """
+    Decorator that profiles all calls of a function as stage name.
+    :param items: optional function that returns the number of processed items
+           of the stage, given the return value of the function
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name) as s:
+                ret = f(*args, **kwargs)
+                if items is not None and profiler() is not None:
+                    s.items = items(ret)
+            return ret
+        return wrapper
+    return decorator
@@ -0,0 +1,175 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import os
+import pickle
+import struct
+
+from collections import OrderedDict
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+# Stores this process is attached to, cf. CommitStore.attach()
+#  key: filename
+#  value: ((inode, mtime), CommitStore)
+_attached = dict()
+
+
+class CommitStore:
+    """
+    A read-only file of pickled commits that is memory-mapped by all
+    processes that attach to it. Unlike the commit cache of a forked
+    Repository, the pages of the store are never written, and thus shared
+    among all workers, no matter how many workers attach.
+
+    Layout of the file:
+      MAGIC
+      pickled commits
+      identifiers, utf-8 encoded
+      index: one ENTRY per commit, sorted by identifier
+      TRAILER
+    """
+    MAGIC = b'PaStA-CS'
+    # offset and length of the identifier, offset and length of the commit
+    ENTRY = struct.Struct('<QQQQ')
+    # offset of the index, number of entries, MAGIC
+    TRAILER = struct.Struct('<QQ8s')
+
+    def __init__(self, filename, cache_size=1024):
+        """
+        Attaches to the store filename.
+        :param cache_size: number of unpickled commits that are kept by this
+               process
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._index, self._entries, magic = \
+            CommitStore.TRAILER.unpack_from(
+                self._mm, len(self._mm) - CommitStore.TRAILER.size)
+        if magic != CommitStore.MAGIC or \
+           self._mm[:len(CommitStore.MAGIC)] != CommitStore.MAGIC:
+            raise ValueError('%s is not a commit store' % filename)
+
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    @staticmethod
+    def attach(filename):
+        """
+        Returns the CommitStore filename of this process. Workers stay
+        attached, and keep their unpickled commits, between tasks until the
+        store is replaced.
+        """
+        stat = os.stat(filename)
+        version = stat.st_ino, stat.st_mtime_ns
+
+        attached = _attached.get(filename)
+        if attached is None or attached[0] != version:
+            if attached is not None:
+                attached[1].close()
+            _attached[filename] = version, CommitStore(filename)
+
+        return _attached[filename][1]
+
+    @staticmethod
+    def create(filename, commits):
+        """
+        Writes the commits to a new store filename.
+        :param commits: iterable of (identifier, commit)
+        """
+        index = list()
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(CommitStore.MAGIC)
+
+            for identifier, commit in commits:
+                offset = f.tell()
+                pickle.dump(commit, f, pickle.HIGHEST_PROTOCOL)
+                index.append((identifier.encode('utf-8', 'surrogateescape'),
+                              offset, f.tell() - offset))
+
+            index.sort()
+            entries = list()
+            for identifier, offset, length in index:
+                entries.append(CommitStore.ENTRY.pack(f.tell(), len(identifier),
+                                                      offset, length))
+                f.write(identifier)
+
+            index_offset = f.tell()
+            for entry in entries:
+                f.write(entry)
+            f.write(CommitStore.TRAILER.pack(index_offset, len(entries),
+                                             CommitStore.MAGIC))
+        os.replace(tmp, filename)
+
+        log.info('Wrote %d commits to commit store %s' %
+                 (len(index), filename))
+
+    def _entry(self, i):
+        return CommitStore.ENTRY.unpack_from(
+            self._mm, self._index + i * CommitStore.ENTRY.size)
+
+    def _identifier(self, i):
+        offset, length, _, _ = self._entry(i)
+        return self._mm[offset:offset + length]
+
+    def _find(self, identifier):
+        identifier = identifier.encode('utf-8', 'surrogateescape')
+        lo, hi = 0, self._entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._identifier(mid) < identifier:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._entries and self._identifier(lo) == identifier:
+            return lo
+        return None
+
+    def __getitem__(self, identifier):
+        if identifier in self._cache:
+            self._cache.move_to_end(identifier)
+            return self._cache[identifier]
+
+        i = self._find(identifier)
+        if i is None:
+            raise KeyError('Commit or Mail not found in commit store: %s' %
+                           identifier)
+
+        _, _, offset, length = self._entry(i)
+        with memoryview(self._mm)[offset:offset + length] as buffer:
+            commit = pickle.loads(buffer)
+
+        self._cache[identifier] = commit
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+        return commit
+
+    def __contains__(self, identifier):
+        return identifier in self._cache or self._find(identifier) is not None
+
+    def __len__(self):
+        return self._entries
+
+    def keys(self):
+        for i in range(self._entries):
+            yield self._identifier(i).decode('utf-8', 'surrogateescape')
+
+    def close(self):
+        self._cache.clear()
+        self._mm.close()
@@ -51,6 +51,8 @@ def decode_payload(message):
 
 
 class PatchMail(MessageDiff):
+    __slots__ = ['mail_subject']
+
     @staticmethod
     def extract_patch_mail(mail):
         id = mail['message-id']
@@ -98,7 +100,7 @@ class PatchMail(MessageDiff):
 
         raise ValueError('Unable to find suitable payload')
 
-    def __init__(self, mail, identifier):
+    def __init__(self, mail, identifier, eager=False):
         # Get informations on the author
         date = mail_parse_date(mail['Date'], assume_epoch=True)
 
@@ -124,7 +126,7 @@ class PatchMail(MessageDiff):
 
         content = msg, annotation, diff
 
-        super(PatchMail, self).__init__(identifier, content, author)
+        super(PatchMail, self).__init__(identifier, content, author, eager)
 
     def format_message(self):
         custom = ['Mail Subject: %s' % self.subject]
@@ -586,6 +588,15 @@ class Mbox:
         return False
 
     def __getitem__(self, message_id):
+        return self.get_patch(message_id)
+
+    def get_patch(self, message_id, eager=False):
+        """
+        Returns the PatchMail of the first message with message_id that
+        contains a patch.
+        :param eager: parse the diff immediately, and skip messages with
+               invalid diffs
+        """
         messages = self.get_messages(message_id)
         exception = None
 
@@ -594,7 +605,7 @@ class Mbox:
 
         for message in messages:
             try:
-                patch = PatchMail(message, message_id)
+                patch = PatchMail(message, message_id, eager)
                 return patch
             except Exception as e:
                 exception = e
@@ -10,22 +10,38 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 import re
+import sys
+
 from collections import defaultdict
 
-from .Patch import Diff
+from .Patch import Compact, Diff
+from ..Util import token_sort_key
+
 
+class Signature(Compact):
+    __slots__ = ['name', 'email', 'date']
 
-class Signature:
     def __init__(self, name, email, date):
-        self.name = name
-        self.email = email
+        # Authors repeat across many patches
+        self.name = sys.intern(name)
+        self.email = sys.intern(email)
         self.date = date
 
+    def upgrade(self, state):
+        self.name = sys.intern(self.name)
+        self.email = sys.intern(self.email)
+
 
-class MessageDiff:
+class MessageDiff(Compact):
     """
     An abstract class that consists of a message, and a diff.
     """
+    __slots__ = ['identifier', 'author', 'annotation', 'raw_message', 'tags',
+                 'message', 'message_key', 'linux_links', 'is_revert', '_diff',
+                 '_lines']
+    LEGACY_SLOTS = {1: ['identifier', 'author', 'annotation', 'raw_message',
+                        'tags', 'message', 'message_key', 'linux_links',
+                        'is_revert', 'diff']}
 
     # Tags used in Linux kernel mailing lists
     VALID_TAGS = (r'^('
@@ -78,7 +94,13 @@ class MessageDiff:
     TAG_REGEX = re.compile(r'^%s\s*:\s*(.*)$' % VALID_TAGS, re.IGNORECASE)
     LINUX_ML_PREFIX = re.compile(r'https?://(lore|lkml).kernel.org')
 
-    def __init__(self, identifier, content, author):
+    def __init__(self, identifier, content, author, eager=False):
+        """
+        :param content: tuple of the lines of the message, the annotation and
+               the lines of the diff
+        :param eager: parse the diff immediately. By default, it is parsed
+               on first access, cf. diff.
+        """
         self.identifier = identifier
         self.author = author
 
@@ -99,7 +121,8 @@ class MessageDiff:
                     self.message.append(line)
                 else:
                     tag, content = match.group(1), match.group(2)
-                    self.tags[tag.lower().strip()].append(content.strip())
+                    tag = sys.intern(tag.lower().strip())
+                    self.tags[tag].append(content.strip())
         else:
             self.message = message
 
@@ -107,14 +130,44 @@ class MessageDiff:
         if len(self.message) > 1 and self.message[0] == self.message[1]:
             self.message.pop(0)
 
+        # Token-sorted key of the message, used for rating messages
+        self.message_key = token_sort_key(self.message)
+
         self.linux_links = [x for x in self.tags['link']
                             if MessageDiff.LINUX_ML_PREFIX.match(x)]
 
         # is a revert message?
         self.is_revert = any('revert' in x.lower() for x in self.raw_message)
 
+        # The diff is only parsed on first access. Many users only need the
+        # message and author of a patch.
+        self._diff = None
+        self._lines = diff
+        if eager:
+            self._parse()
+
+    def _parse(self):
         # do the tricky part: parse the diff
-        self.diff = Diff(diff)
+        self._diff = Diff(self._lines)
+        # The Diff keeps the lines as raw diff
+        self._lines = None
+
+    @property
+    def diff(self):
+        if self._diff is None:
+            self._parse()
+        return self._diff
+
+    @property
+    def parsed(self):
+        return self._diff is not None
+
+    def upgrade(self, state):
+        if 'message_key' not in state:
+            self.message_key = token_sort_key(self.message)
+        if 'diff' in state:
+            self._diff = state['diff']
+            self._lines = None
 
     def format_message(self, custom):
         type = 'Commit:    ' if self.identifier[0] != '<' else 'Message-ID:'
@@ -9,21 +9,185 @@ Author:
 This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
+import hashlib
 import re
+import sys
+
+from fuzzywuzzy import fuzz
+from pygit2 import GIT_DELTA_ADDED, GIT_DELTA_COPIED, GIT_DELTA_DELETED, \
+                   GIT_DELTA_RENAMED
+
+from ..Util import token_sort_key
+
+
+def fingerprint(content):
+    """
+    Returns a stable content hash of a nested tuple of strings and numbers
+    """
+    content = repr(content).encode('utf-8', 'surrogateescape')
+    return hashlib.sha1(content).digest()
+
+
+def ambiguous_keys(keys):
+    """
+    Checks if any two token sort keys are equal or rated with a similarity of
+    100. If not, mapping a list of keys against itself (cf.
+    best_string_mapping()) results in the identity.
+    """
+    keys = sorted(keys, key=len)
+    for i, key in enumerate(keys):
+        for other in keys[i+1:]:
+            if key == other:
+                return True
+
+            # Different keys can only be rounded to a similarity of 100 if
+            # their lengths are close, and if they're long enough.
+            lensum = len(key) + len(other)
+            if 200 * len(key) < 99 * lensum:
+                break
+            if lensum < 200:
+                continue
+
+            if fuzz.ratio(key, other) == 100:
+                return True
+
+    return False
+
+
+class Compact:
+    """
+    Base class of parsed patches. Commit caches contain millions of them.
+    Instances have no __dict__ but only __slots__, and are pickled as a tuple
+    of the VERSION of the representation and the values of all slots.
+    Instances that were pickled before, as dictionary of their attributes or
+    with the slots of an older version, are converted when they are loaded,
+    cf. upgrade().
+    """
+    __slots__ = ()
+
+    # Version of the pickled representation. Increment it when the slots of
+    # any subclass change, and record the previous slots of the subclass in
+    # its LEGACY_SLOTS.
+    VERSION = 3
+
+    # key: version, value: slots of the class in this version, if they differ
+    LEGACY_SLOTS = dict()
+
+    # key: (class, version), value: names of all slots of the class, in order
+    _slots = dict()
+
+    @classmethod
+    def slots(cls, version=VERSION):
+        slots = Compact._slots.get((cls, version))
+        if slots is None:
+            slots = list()
+            for klass in reversed(cls.__mro__):
+                own = klass.__dict__.get('__slots__', ())
+                slots += klass.__dict__.get('LEGACY_SLOTS', {}).get(version,
+                                                                    own)
+            slots = tuple(slots)
+            Compact._slots[cls, version] = slots
+        return slots
+
+    def __getstate__(self):
+        return (Compact.VERSION,) + tuple(getattr(self, slot, None)
+                                          for slot in self.slots())
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple) and state[0] != Compact.VERSION:
+            if not 1 <= state[0] < Compact.VERSION:
+                raise ValueError('Unknown version %d of pickled %s' %
+                                 (state[0], type(self).__name__))
+            state = dict(zip(self.slots(state[0]), state[1:]))
+
+        if isinstance(state, dict):
+            for slot in self.slots():
+                if slot in state:
+                    setattr(self, slot, state[slot])
+            self.upgrade(state)
+            return
+
+        for slot, value in zip(self.slots(), state[1:]):
+            setattr(self, slot, value)
+
+    def upgrade(self, state):
+        """
+        Completes an instance that was loaded from state, a dictionary of
+        attributes as they were pickled before.
+        """
+        pass
 
 
-class Hunk:
+class Hunk(Compact):
+    __slots__ = ['insertions', 'deletions', 'context',
+                 'insertions_key', 'deletions_key', 'fingerprint']
+
+    # Intern lines and keys of unpickled hunks, cf. intern(). Lines within a
+    # single commit cache are already shared by the pickle memo, interning
+    # shares them across commit caches and worker results, at the cost of
+    # slower loading.
+    INTERN_ON_LOAD = False
+
     def __init__(self, insertions=None, deletions=None, context=None):
         self.insertions = insertions or []
         self.deletions = deletions or []
         self.context = context or []
 
+        # Token-sorted keys of insertions and deletions, used for rating hunks
+        self.insertions_key = None
+        self.deletions_key = None
+
+        # Content hash of insertions and deletions
+        self.fingerprint = None
+
     def merge(self, other):
         self.insertions += other.insertions
         self.deletions += other.deletions
         self.context += other.context
 
-class Patch:
+    def update_keys(self):
+        # Hunks don't change after parsing
+        self.insertions = tuple(self.insertions)
+        self.deletions = tuple(self.deletions)
+        self.context = tuple(self.context)
+
+        self.insertions_key = token_sort_key(self.insertions)
+        self.deletions_key = token_sort_key(self.deletions)
+        self.fingerprint = fingerprint((self.insertions, self.deletions))
+        self.intern()
+
+    def intern(self):
+        """
+        Interns lines and keys. Lines like '}' or 'return 0;', and often
+        entire hunks, repeat across many patches and across commit caches.
+        Interned, they are kept in memory, and pickled into a commit cache,
+        only once.
+        """
+        self.insertions = tuple(map(sys.intern, self.insertions))
+        self.deletions = tuple(map(sys.intern, self.deletions))
+        self.context = tuple(map(sys.intern, self.context))
+        self.insertions_key = sys.intern(self.insertions_key)
+        self.deletions_key = sys.intern(self.deletions_key)
+
+    def __setstate__(self, state):
+        # Unpickled strings are not interned
+        super(Hunk, self).__setstate__(state)
+        if Hunk.INTERN_ON_LOAD:
+            self.intern()
+
+    def upgrade(self, state):
+        if 'fingerprint' in state:
+            self.insertions = tuple(self.insertions)
+            self.deletions = tuple(self.deletions)
+            self.context = tuple(self.context)
+        else:
+            self.update_keys()
+
+
+class Patch(Compact):
+    __slots__ = ['similarity', 'hunks', 'heading_keys', 'fingerprint',
+                 'unambiguous']
+
     def __init__(self, similarity=0, hunks=None):
         self.similarity = similarity
         if hunks:
@@ -31,8 +195,45 @@ class Patch:
         else:
             self.hunks = {}
 
+        # Token-sorted keys of hunk headings
+        #  key: hunk heading
+        #  value: token_sort_key(hunk heading)
+        self.heading_keys = {}
+
+        # Content hash of the similarity and all hunks, in order
+        self.fingerprint = None
+
+        # True, if no two hunk headings can be confused when rating the patch
+        # against itself
+        self.unambiguous = True
+
+    def update_keys(self):
+        self.heading_keys = {heading: sys.intern(token_sort_key(heading))
+                             for heading in self.hunks.keys()}
+        for hunk in self.hunks.values():
+            hunk.update_keys()
+
+        self.fingerprint = fingerprint((self.similarity,
+                                        tuple((heading, hunk.fingerprint)
+                                              for heading, hunk
+                                              in self.hunks.items())))
+        self.unambiguous = not ambiguous_keys(self.heading_keys.values())
+
+    def upgrade(self, state):
+        self.hunks = {sys.intern(heading): hunk
+                      for heading, hunk in self.hunks.items()}
+        if 'fingerprint' in state:
+            self.heading_keys = {sys.intern(heading): sys.intern(key)
+                                 for heading, key
+                                 in self.heading_keys.items()}
+        else:
+            self.update_keys()
+
+
+class Diff(Compact):
+    __slots__ = ['raw', 'patches', 'affected', 'filename_keys', 'fingerprint',
+                 'unambiguous', 'lines', 'footer']
 
-class Diff:
     # The two-line unified diff headers
     FILE_SEPARATOR_MINUS_REGEX = re.compile(r'^--- ([^\s]+).*$')
     #r'^--- (?P<filename>[^\t\n]+)(?:\t(?P<timestamp>[^\n]+))?')
@@ -52,17 +253,17 @@ class Diff:
     LINE_IDENTIFIER_CONTEXT = ' '
     LINE_IDENTIFIER_NEWLINE = '\\'
 
-    def __init__(self, diff):
-        def insert_file(filenames, similarity):
-            self.affected |= set(filenames)
-            if filenames not in self.patches:
-                self.patches[filenames] = Patch(similarity=similarity)
-
-        # we pop from the list until it is empty. Copy it first, to prevent its
-        # deletion
-        diff = diff.copy()
+    # Paths that git quotes in the headers of diffs
+    QUOTED_PATH_REGEX = re.compile(r'[^ -~]|["\\]')
 
-        self.raw = diff.copy()
+    def __init__(self, diff):
+        """
+        Parses the lines of a unified diff. The lines are walked once, and are
+        not copied: the Diff keeps a reference to diff as raw diff, so diff
+        must not be modified afterwards.
+        :param diff: list of lines
+        """
+        self.raw = diff
 
         # patches store patches of files
         #  key: (filename,) or (old_filename, new_filename)
@@ -72,32 +273,55 @@ class Diff:
         # Set of all filenames that were affected by this diff
         self.affected = set()
 
+        # Token-sorted keys of the filenames of patches
+        #  key: (filename,) or (old_filename, new_filename)
+        #  value: token_sort_key(key)
+        self.filename_keys = {}
+
+        # Content hash of all patches, in order. Diffs with equal fingerprints
+        # are rated identically.
+        self.fingerprint = None
+
+        # True, if no two filenames can be confused when rating the diff
+        # against itself
+        self.unambiguous = True
+
         self.lines = 0
+        # Number of trailing lines that are not part of any hunk
+        self.footer = 0
 
         # Check if we understand the diff format
         if diff and Diff.EXCLUDE_CC_REGEX.match(diff[0]):
+            self.update_keys()
             return
 
+        # Cursor: index of the next line to consume. Consuming a line beyond
+        # the end of the diff raises an IndexError.
+        i = 0
+        length = len(diff)
+
         # We need at least three lines for any kind of reasonable patch
-        while len(diff):
-            self.footer = len(diff)
+        while i < length:
+            self.footer = length - i
 
             # We are either looking for a line beginning with '---' or
             # a similarity index
             similarity = 0
-            while len(diff):
-                line = diff.pop(0)
+            while i < length:
+                line = diff[i]
+                i += 1
 
                 match = Diff.FILE_SEPARATOR_MINUS_REGEX.match(line)
                 if match:
                     minus = match.group(1)
-                    plus = Diff.FILE_SEPARATOR_PLUS_REGEX.match(diff.pop(0)).group(1)
+                    plus = Diff.FILE_SEPARATOR_PLUS_REGEX.match(diff[i]).group(1)
+                    i += 1
                     filenames = Diff.get_filename(minus, plus)
                     break
 
                 match = Diff.SIMILARITY_INDEX_REGEX.match(line)
                 if match:
-                    if len(diff) < 2:
+                    if length - i < 2:
                         print('ERROR')
 
                     similarity = int(match.group(1))
@@ -105,24 +329,29 @@ class Diff:
                     # Only consume the next two lines if the similarity is 100.
                     # If the similarity is not 100, then hunks _must_ follow.
                     if similarity == 100:
-                        minus = Diff.RENAME_REGEX.match(diff.pop(0)).group(3)
-                        plus= Diff.RENAME_REGEX.match(diff.pop(0)).group(3)
+                        minus = Diff.RENAME_REGEX.match(diff[i]).group(3)
+                        i += 1
+                        plus = Diff.RENAME_REGEX.match(diff[i]).group(3)
+                        i += 1
 
                         # In case we parse the 'rename from/to' lines, we must
                         # not sanitise the filenames and strip away anything
-                        filenames = minus, plus
+                        filenames = sys.intern(minus), sys.intern(plus)
 
                         break
 
             if similarity == 100:
-                insert_file(filenames, 100)
+                self._insert_file(filenames, 100)
                 continue
 
-            if len(diff) == 0:
+            if i == length:
                 break
 
-            while len(diff) and Diff.HUNK_REGEX.match(diff[0]):
-                hunk = Diff.HUNK_REGEX.match(diff.pop(0))
+            while i < length:
+                hunk = Diff.HUNK_REGEX.match(diff[i])
+                if not hunk:
+                    break
+                i += 1
 
                 # l_start = int(hunk.group(1))
                 l_lines = 1
@@ -134,7 +363,7 @@ class Diff:
                 if hunk.group(4):
                     r_lines = int(hunk.group(4))
 
-                hunk_heading = hunk.group(5)
+                hunk_heading = sys.intern(hunk.group(5))
 
                 del_cntr = 0
                 add_cntr = 0
@@ -144,7 +373,8 @@ class Diff:
                 context = []
 
                 while not (del_cntr == l_lines and add_cntr == r_lines):
-                    line = diff.pop(0)
+                    line = diff[i]
+                    i += 1
 
                     # Assume an empty string to be an invariant newline
                     # (this happens quite often when parsing mails)
@@ -179,23 +409,174 @@ class Diff:
                         # We simply ignore these lines.
                         continue
 
-                # remove empty lines
-                insertions = list(filter(None, insertions))
-                deletions = list(filter(None, deletions))
-                context = list(filter(None, context))
+                self._insert_hunk(filenames, similarity, hunk_heading,
+                                  insertions, deletions, context)
+                self.footer = length - i
 
-                h = Hunk(insertions, deletions, context)
+        self.affected.discard('/dev/null')
 
-                insert_file(filenames, similarity)
+        # Normalise everything that is required for rating diffs once, and not
+        # on every comparison
+        self.update_keys()
 
-                if hunk_heading not in self.patches[filenames].hunks:
-                    self.patches[filenames].hunks[hunk_heading] = Hunk()
+    @staticmethod
+    def from_pygit2(diff):
+        """
+        Creates the Diff of a pygit2.Diff from pygit2's patches, hunks and
+        lines instead of rendering and parsing the text of the diff. The
+        contents equal those of Diff(diff.patch.split('\n')), but the raw diff
+        and its footer are not available (None).
+        :param diff: pygit2.Diff
+        """
+        patches = list(diff)
+
+        # git quotes such paths in the text of the diff. Leave them to the
+        # parser.
+        for patch in patches:
+            delta = patch.delta
+            if Diff.QUOTED_PATH_REGEX.search(delta.old_file.path) or \
+               Diff.QUOTED_PATH_REGEX.search(delta.new_file.path):
+                return Diff((diff.patch or '').split('\n'))
+
+        ret = Diff([])
+        ret.raw = None
+        ret.footer = None
+
+        # Like the similarity index in the text, the similarity of a delta
+        # without hunks (e.g., binary files) carries over to the next file
+        similarity = 0
+        for patch in patches:
+            delta = patch.delta
+            status = delta.status
+
+            if status == GIT_DELTA_RENAMED or status == GIT_DELTA_COPIED:
+                similarity = delta.similarity
+                if similarity == 100:
+                    ret._insert_file((sys.intern(delta.old_file.path),
+                                      sys.intern(delta.new_file.path)), 100)
+                    similarity = 0
+                    continue
+
+            hunks = patch.hunks
+            if not hunks:
+                continue
 
-                # hunks may occur twice or more often
-                self.patches[filenames].hunks[hunk_heading].merge(h)
-                self.footer = len(diff)
+            # Derive the filenames from the same header lines as the parser
+            minus = '--- /dev/null' if status == GIT_DELTA_ADDED else \
+                    '--- a/' + delta.old_file.path
+            plus = '+++ /dev/null' if status == GIT_DELTA_DELETED else \
+                   '+++ b/' + delta.new_file.path
+            minus = Diff.FILE_SEPARATOR_MINUS_REGEX.match(minus).group(1)
+            plus = Diff.FILE_SEPARATOR_PLUS_REGEX.match(plus).group(1)
+            filenames = Diff.get_filename(minus, plus)
 
-        self.affected.discard('/dev/null')
+            for hunk in hunks:
+                hunk_heading = sys.intern(
+                    Diff.HUNK_REGEX.match(hunk.header).group(5))
+
+                insertions = []
+                deletions = []
+                context = []
+
+                for line in hunk.lines:
+                    origin = line.origin
+                    if origin == Diff.LINE_IDENTIFIER_INSERTION:
+                        payloads = insertions
+                        ret.lines += 1
+                    elif origin == Diff.LINE_IDENTIFIER_DELETION:
+                        payloads = deletions
+                        ret.lines += 1
+                    elif origin == Diff.LINE_IDENTIFIER_CONTEXT:
+                        payloads = context
+                    else:
+                        # '\ No newline at end of file' markers
+                        continue
+
+                    content = line.content
+                    if content[-1:] == '\n':
+                        content = content[:-1]
+                    payloads.append(content)
+
+                ret._insert_hunk(filenames, similarity, hunk_heading,
+                                 insertions, deletions, context)
+
+            similarity = 0
+
+        ret.affected.discard('/dev/null')
+        ret.update_keys()
+
+        return ret
+
+    def _insert_file(self, filenames, similarity):
+        self.affected |= set(filenames)
+        if filenames not in self.patches:
+            self.patches[filenames] = Patch(similarity=similarity)
+
+    def _insert_hunk(self, filenames, similarity, heading, insertions,
+                     deletions, context):
+        # remove empty lines
+        insertions = list(filter(None, insertions))
+        deletions = list(filter(None, deletions))
+        context = list(filter(None, context))
+
+        h = Hunk(insertions, deletions, context)
+
+        self._insert_file(filenames, similarity)
+
+        if heading not in self.patches[filenames].hunks:
+            self.patches[filenames].hunks[heading] = Hunk()
+
+        # hunks may occur twice or more often
+        self.patches[filenames].hunks[heading].merge(h)
+
+    def update_keys(self):
+        self.filename_keys = {filenames: sys.intern(token_sort_key(filenames))
+                              for filenames in self.patches.keys()}
+        for patch in self.patches.values():
+            patch.update_keys()
+
+        self.fingerprint = fingerprint((self.lines,
+                                        tuple((filenames, patch.fingerprint)
+                                              for filenames, patch
+                                              in self.patches.items())))
+        self.unambiguous = not ambiguous_keys(self.filename_keys.values())
+
+    def upgrade(self, state):
+        def intern(filenames):
+            return tuple(sys.intern(x) for x in filenames)
+
+        self.footer = state.get('footer', 0)
+        self.patches = {intern(filenames): patch
+                        for filenames, patch in self.patches.items()}
+        self.affected = set(intern(self.affected))
+        if 'fingerprint' in state:
+            self.filename_keys = {intern(filenames): sys.intern(key)
+                                  for filenames, key
+                                  in self.filename_keys.items()}
+        else:
+            self.update_keys()
+
+    @property
+    def perfect(self):
+        """
+        True, if rating the diff against a diff with the same fingerprint
+        results in a perfect rating.
+        """
+        if not self.unambiguous:
+            return False
+
+        rated = False
+        for patch in self.patches.values():
+            if not patch.unambiguous:
+                return False
+
+            # Files without similarity index and without any insertions or
+            # deletions don't contribute to the rating
+            if patch.similarity or any(hunk.insertions or hunk.deletions
+                                       for hunk in patch.hunks.values()):
+                rated = True
+
+        return rated
 
     def split_footer(self):
         if self.footer > 0:
@@ -224,6 +605,10 @@ class Diff:
         a = sanitise_filename(a)
         b = sanitise_filename(b)
 
+        # Filenames repeat across many diffs
+        a = sys.intern(a)
+        b = sys.intern(b)
+
         # no move - we modify the file in place
         if a == b:
             return a,
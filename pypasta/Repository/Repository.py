@@ -12,18 +12,26 @@ the COPYING file in the top-level directory.
 
 import gc
 import git
+import os
 import pickle
 import pygit2
 import re
+import tempfile
+import weakref
 
+from functools import partial
 from logging import getLogger
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
+from .CommitStore import CommitStore
 from .MessageDiff import MessageDiff, Signature
 from .Mbox import Mbox
+from .Patch import Diff
+from ..Profiler import stage
 from ..Util import fix_encoding, get_commit_hash_range,\
                    pygit2_signature_to_datetime
+from ..WorkerPool import worker_repository
 
 log = getLogger(__name__[-15:])
 
@@ -40,37 +48,87 @@ class PygitCredentials(pygit2.RemoteCallbacks):
             return None
 
 
+def diff_to_parent(commit):
+    """
+    Returns the pygit2.Diff of a pygit2 commit to its parent, or None for
+    merge commits and commits with no parents
+    """
+    if len(commit.parents) != 1:
+        return None
+
+    diff = commit.parents[0].tree.diff_to_tree(commit.tree)
+    diff.find_similar()
+    return diff
+
+
+def render_diff(commit):
+    """
+    Returns the lines of the diff of a pygit2 commit to its parent
+    """
+    # default: diff is empty. This filters merge commits and commits with no
+    # parents
+    diff = diff_to_parent(commit)
+    # there may be empty commits
+    if diff is None or not diff.patch:
+        return ['']
+    return diff.patch.split('\n')
+
+
 class Commit(MessageDiff):
+    __slots__ = ['committer', '_commit']
+    LEGACY_SLOTS = {1: ['committer'], 2: ['committer']}
+
     @staticmethod
     def get_signature(pygit_person):
         return Signature(fix_encoding(pygit_person.raw_name),
                          pygit_person.email,
                          pygit2_signature_to_datetime(pygit_person))
 
-    def __init__(self, repo, commit_hash):
+    def __init__(self, repo, commit_hash, eager=False):
         commit = repo[commit_hash]
 
         author = Commit.get_signature(commit.author)
         self.committer = Commit.get_signature(commit.committer)
 
-        # default: diff is empty. This filters merge commits and commits with no
-        # parents
-        diff = ''
-        if len(commit.parents) == 1:
-            diff = repo.diff(commit.parents[0], commit)
-            diff.find_similar()
-            diff = diff.patch
-            # there may be empty commits
-            if not diff:
-                diff = ''
-
-        # split message and diff at newlines
+        # The diff is created from the pygit2 commit on first access, cf.
+        # _parse()
+        self._commit = commit
+
+        # split message at newlines
         message = fix_encoding(commit.raw_message).split('\n')
-        diff = diff.split('\n')
 
-        content = message, None, diff
+        content = message, None, None
 
-        super(Commit, self).__init__(commit.hex, content, author)
+        super(Commit, self).__init__(commit.hex, content, author, eager)
+
+    def _parse(self):
+        commit = self._commit
+        if commit is None:
+            # The diff was rendered when the commit was pickled
+            return super(Commit, self)._parse()
+
+        # default: diff is empty. This filters merge commits and commits with no
+        # parents
+        diff = diff_to_parent(commit)
+        if diff is None:
+            self._diff = Diff([''])
+        else:
+            # Rendering and parsing the text of the diff takes longer than
+            # walking the patches of pygit2
+            self._diff = Diff.from_pygit2(diff)
+        self._commit = None
+
+    def upgrade(self, state):
+        super(Commit, self).upgrade(state)
+        self._commit = None
+
+    def __getstate__(self):
+        # pygit2 objects can't be pickled. Pickle the text of the diff
+        # instead, it is still parsed on first access.
+        if self._commit is not None:
+            self._lines = render_diff(self._commit)
+            self._commit = None
+        return super(Commit, self).__getstate__()
 
     def format_message(self):
         custom = ['Committer:  %s <%s>' %
@@ -79,19 +137,35 @@ class Commit(MessageDiff):
         return super(Commit, self).format_message(custom)
 
 
-def _load_commit_subst(commit_hash):
-    return commit_hash, _tmp_repo._load_commit(commit_hash)
+def _load_commit_subst(eager, commit_hash):
+    return commit_hash, _tmp_repo._load_commit(commit_hash, eager)
+
+
+def _load_commit_pooled(eager, commit_hash):
+    return commit_hash, worker_repository()._load_commit(commit_hash, eager)
 
 
 class Repository:
     REGEX_TAGS = re.compile('^refs/tags')
 
+    # Size of the largest blob that libgit2 caches
+    BLOB_CACHE_LIMIT = 256 * 1024
+
     def __init__(self, repo_location):
         self.repo_location = repo_location
         self.ccache = {}
         self.repo = pygit2.Repository(repo_location)
+        # libgit2 doesn't cache blobs by default. Diffs of successive commits
+        # load the same blobs.
+        pygit2.settings.cache_object_limit(pygit2.GIT_OBJ_BLOB,
+                                           Repository.BLOB_CACHE_LIMIT)
         self.mbox = None
 
+        # Filename of the CommitStore of the commit cache, and the identifiers
+        # it contains, cf. commit_store()
+        self.f_commit_store = None
+        self._store_identifiers = set()
+
         self.tags = list()
         tag_refs = filter(lambda r: self.REGEX_TAGS.match(r),
                           self.repo.listall_references())
@@ -144,13 +218,13 @@ class Repository:
     def clear_commit_cache(self):
         self.ccache.clear()
 
-    def _load_commit(self, identifier):
+    def _load_commit(self, identifier, eager=False):
         # check if the victim is an email
         try:
             if identifier[0] == '<':
-                return self.mbox[identifier]
+                return self.mbox.get_patch(identifier, eager)
             else:
-                return Commit(self.repo, identifier)
+                return Commit(self.repo, identifier, eager)
         except Exception as e:
             log.debug('Unable to load commit %s: %s' % (identifier, str(e)))
             return None
@@ -218,41 +292,68 @@ class Repository:
         gc.collect()
         return victims
 
-    def cache_commits(self, identifiers, parallelise=True, cpu_factor=1):
+    def cache_commits(self, identifiers, parallelise=True, cpu_factor=1,
+                      pool=None, eager=True):
         """
         Caches a list of commit hashes
         :param identifiers: List of identifiers
         :param parallelise: parallelise
+        :param pool: WorkerPool that was created with this repository. If set,
+               it is used instead of a new pool.
+        :param eager: parse the diffs while caching, and treat commits with
+               invalid diffs as invalid. Commits that were cached without
+               parsing their diffs (e.g., by get_commit()) are loaded again.
+               Set it to False, if only the messages and authors of the
+               commits are needed.
         """
         num_cpus = int(cpu_factor * cpu_count())
         # deactivate parallelistation, if we only have a single CPU
         if num_cpus <= 1:
             parallelise = False
         already_cached = set(self.ccache.keys())
-        identifiers = set(identifiers)
-        worklist = identifiers - already_cached
+        # Keep the order of identifiers. Successive commits share blobs, and
+        # libgit2 caches them.
+        identifiers = list(dict.fromkeys(identifiers))
+        worklist = [x for x in identifiers
+                    if x not in already_cached or
+                    (eager and not self.ccache[x].parsed)]
 
         if len(worklist) == 0:
-            return identifiers
+            return set(identifiers)
 
         log.info('Caching %d/%d commits' % (len(worklist), len(identifiers)))
 
-        if parallelise:
-            global _tmp_repo
-            _tmp_repo = self
-
-            with Pool(num_cpus, maxtasksperchild=100) as p:
-                result = list(tqdm(p.imap(_load_commit_subst, worklist,
-                                          chunksize=1000),
+        with stage('cache_commits', len(worklist)):
+            if pool is not None and pool.repo is self:
+                result = list(tqdm(pool.imap(partial(_load_commit_pooled,
+                                                     eager),
+                                             worklist, chunksize=1000,
+                                             stage='Caching'),
                                    total=len(worklist)))
+            elif parallelise:
+                global _tmp_repo
+                _tmp_repo = self
 
-            _tmp_repo = None
-        else:
-            result = list(map(lambda x: (x, self._load_commit(x)), worklist))
+                with Pool(num_cpus, maxtasksperchild=100) as p:
+                    result = list(tqdm(p.imap(partial(_load_commit_subst,
+                                                      eager),
+                                              worklist, chunksize=1000),
+                                       total=len(worklist)))
+
+                _tmp_repo = None
+            else:
+                result = list(map(lambda x: (x, self._load_commit(x, eager)),
+                                  worklist))
 
         invalid = {key for (key, value) in result if value is None}
         result = {key: value for (key, value) in result if value is not None}
 
+        # Commits that were cached without parsing might turn out to be
+        # invalid
+        for key in invalid & already_cached:
+            del self.ccache[key]
+        already_cached -= invalid
+
         if self.mbox:
             invalid_mail = {x for x in invalid if x[0] == '<'}
             self.mbox.invalidate(invalid_mail)
@@ -261,6 +362,41 @@ class Repository:
 
         return already_cached | set(result.keys())
 
+    def commit_store(self, identifiers):
+        """
+        Returns the filename of a CommitStore that contains identifiers.
+        Worker processes attach to the store instead of inheriting the commit
+        cache of this process.
+
+        The store is reused as long as it contains all identifiers. Otherwise,
+        it is replaced by a store of identifiers and the identifiers of the
+        previous store. The store never contains the whole commit cache, which
+        might be much larger than what workers need.
+        :param identifiers: identifiers that must be available in the store
+        """
+        identifiers = set(identifiers)
+        if self.f_commit_store and identifiers <= self._store_identifiers:
+            return self.f_commit_store
+
+        self.cache_commits(identifiers)
+        # Keep commits of the previous store, unless they were evicted
+        identifiers |= self._store_identifiers & self.ccache.keys()
+
+        if not self.f_commit_store:
+            fd, self.f_commit_store = tempfile.mkstemp(prefix='pasta-',
+                                                       suffix='.commits')
+            os.close(fd)
+            weakref.finalize(self, os.remove, self.f_commit_store)
+
+        CommitStore.create(self.f_commit_store,
+                           ((x, self.ccache[x]) for x in identifiers
+                            if x in self.ccache))
+        # Invalid identifiers won't ever make it to the store. Don't try
+        # again.
+        self._store_identifiers = identifiers
+
+        return self.f_commit_store
+
     def __getitem__(self, item):
         return self.get_commit(item)
 
@@ -278,7 +414,17 @@ class Repository:
             return self.mbox.get_raw(item)
 
         commit = self[item]
-        return '\n'.join(commit.format_message() + commit.diff.raw)
+        return '\n'.join(commit.format_message() + self.get_raw_diff(item).raw)
+
+    def get_raw_diff(self, item):
+        """
+        Returns the diff of item, including its raw text. Diffs of commits
+        don't keep their text (cf. Diff.from_pygit2()), it is rendered again.
+        """
+        diff = self[item].diff
+        if diff.raw is None:
+            diff = Diff(render_diff(self.repo[item]))
+        return diff
 
     def get_commithash_range(self, range):
         return get_commit_hash_range(self.repo_location, range)
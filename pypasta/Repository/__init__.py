@@ -10,5 +10,6 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 
+from .CommitStore import CommitStore
 from .Repository import Repository, Commit
 from .Mbox import PatchMail, Mbox
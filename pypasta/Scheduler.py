@@ -0,0 +1,144 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import functools
+import math
+import os
+import time
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+
+def _run_bundle(f, bundle):
+    begin = time.time()
+    results = [f(task) for task in bundle]
+    return os.getpid(), begin, time.time(), results
+
+
+class Scheduler:
+    """
+    Distributes tasks of varying cost to the workers of a pool. Tasks are
+    split if they are too expensive, and packed to bundles of similar cost if
+    they are cheap. Bundles are handed out one by one, most expensive first,
+    so idle workers pick up the remaining work.
+    """
+    # Number of bundles per worker. More bundles result in a shorter tail at
+    # the end of the run, but in more overhead.
+    BUNDLES_PER_WORKER = 8
+
+    def __init__(self, processes, cost, split):
+        """
+        :param processes: number of workers of the pool
+        :param cost: function that estimates the cost of a task
+        :param split: function that splits a task into a given number of
+               tasks of roughly equal cost
+        """
+        self.processes = processes
+        self._cost = cost
+        self._split = split
+
+        # (worker pid, begin, end, number of tasks) of all processed bundles
+        self._bundles = list()
+        self._start = None
+        self._end = None
+
+    def bundles(self, tasks):
+        """
+        Returns a list of bundles of tasks, most expensive bundle first
+        """
+        tasks = [(self._cost(task), task) for task in tasks]
+        total = sum([cost for cost, _ in tasks])
+        target = total / (self.processes * Scheduler.BUNDLES_PER_WORKER)
+
+        work = list()
+        for cost, task in tasks:
+            if cost <= target:
+                work.append((cost, task))
+                continue
+
+            # The split function may return fewer tasks, e.g., if a task
+            # can't be split any further
+            parts = math.ceil(cost / target)
+            work += [(self._cost(x), x) for x in self._split(task, parts)]
+        work.sort(key=lambda x: x[0], reverse=True)
+
+        bundles = list()
+        bundle = list()
+        bundle_cost = 0
+        for cost, task in work:
+            bundle.append(task)
+            bundle_cost += cost
+            if bundle_cost >= target:
+                bundles.append(bundle)
+                bundle = list()
+                bundle_cost = 0
+        if bundle:
+            bundles.append(bundle)
+
+        log.info('Scheduling %d tasks in %d bundles' %
+                 (len(work), len(bundles)))
+        return bundles
+
+    def imap(self, pool, f, tasks, **kwargs):
+        """
+        Yields f(task) for all tasks. Splitting tasks is up to the split
+        function, so results of split tasks must be merged by the caller.
+        Further keyword arguments are passed to pool.imap().
+        """
+        bundles = self.bundles(tasks)
+        g = functools.partial(_run_bundle, f)
+
+        self._start = time.time()
+        for pid, begin, end, results in pool.imap(g, bundles, chunksize=1,
+                                                  **kwargs):
+            self._bundles.append((pid, begin, end, len(results)))
+            for result in results:
+                yield result
+        self._end = time.time()
+
+    def report(self):
+        """
+        Logs the utilisation of all workers that processed bundles. Workers
+        are identified by their pid, so a pool that respawns its workers
+        reports more workers than processes.
+        """
+        if self._end is None:
+            return
+
+        wall = self._end - self._start
+
+        # key: pid, value: [bundles, tasks, busy time, end of last bundle]
+        workers = dict()
+        for pid, begin, end, tasks in self._bundles:
+            if pid not in workers:
+                workers[pid] = [0, 0, 0.0, self._start]
+            worker = workers[pid]
+            worker[0] += 1
+            worker[1] += tasks
+            worker[2] += end - begin
+            worker[3] = max(worker[3], end)
+
+        def percent(seconds):
+            return 100 * seconds / wall if wall else 100
+
+        log.info('Worker utilisation (%0.1fs wall time):' % wall)
+        busy = 0.0
+        for pid, (bundles, tasks, seconds, last) in sorted(workers.items()):
+            log.info(' Worker %d: %d bundles, %d tasks, busy %0.1fs (%0.1f%%), '
+                     'idle at the end %0.1fs' %
+                     (pid, bundles, tasks, seconds, percent(seconds),
+                      self._end - last))
+            busy += seconds
+        # Workers that didn't get a bundle were idle all the time
+        log.info(' Total: %0.1f%%' % percent(busy / self.processes))
@@ -0,0 +1,171 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pickle
+import time
+
+from logging import getLogger
+
+from .PatchEvaluation import SCORER_VERSION, SimRating
+
+log = getLogger(__name__[-15:])
+
+
+class SimilarityCache:
+    """
+    A persistent cache of SimRatings of pairs of patches. Ratings only depend
+    on the scorer and on the thresholds that are used during the evaluation of
+    a pair (th, tf, dlr). Changing any other threshold, e.g., ta or ti, keeps
+    all cached ratings valid.
+
+    Ratings are symmetric, so pairs are stored unordered. Pruned ratings are
+    never cached, as they depend on the interactive threshold.
+    """
+    def __init__(self):
+        # key: context, cf. SimilarityCache.context()
+        # value: dictionary with
+        #   key: (lhs, rhs), lhs < rhs
+        #   value: (msg, diff, diff_lines_ratio, time of last use)
+        self.entries = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def context(thresholds):
+        return SCORER_VERSION, thresholds.heading, thresholds.filename, \
+               thresholds.diff_lines_ratio
+
+    @staticmethod
+    def _key(lhs, rhs):
+        if lhs < rhs:
+            return lhs, rhs
+        return rhs, lhs
+
+    def get(self, thresholds, lhs, rhs):
+        """
+        Returns the cached SimRating of lhs and rhs, or None
+        """
+        entries = self.entries.get(SimilarityCache.context(thresholds))
+        key = SimilarityCache._key(lhs, rhs)
+
+        if entries is None or key not in entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        msg, diff, diff_lines_ratio, _ = entries[key]
+        entries[key] = msg, diff, diff_lines_ratio, time.time()
+
+        return SimRating(msg, diff, diff_lines_ratio)
+
+    def put(self, thresholds, lhs, rhs, rating):
+        if lhs == rhs or rating.pruned:
+            return
+
+        context = SimilarityCache.context(thresholds)
+        if context not in self.entries:
+            self.entries[context] = dict()
+
+        self.entries[context][SimilarityCache._key(lhs, rhs)] = \
+            rating.msg, rating.diff, rating.diff_lines_ratio, time.time()
+
+    def slice(self, thresholds, lhs, rhs):
+        """
+        Returns a new cache that only contains the entries of pairs of lhs and
+        rhs. Slices are small enough to be passed to worker processes.
+        """
+        ret = SimilarityCache()
+
+        context = SimilarityCache.context(thresholds)
+        entries = self.entries.get(context)
+        if not entries:
+            return ret
+
+        lhs = set(lhs)
+        rhs = set(rhs)
+        if len(lhs) * len(rhs) < len(entries):
+            keys = {SimilarityCache._key(x, y) for x in lhs for y in rhs}
+            ret.entries[context] = {key: entries[key] for key in keys
+                                    if key in entries}
+        else:
+            ret.entries[context] = {(x, y): value for (x, y), value
+                                    in entries.items()
+                                    if (x in lhs and y in rhs) or
+                                       (x in rhs and y in lhs)}
+
+        return ret
+
+    def evict(self, max_age=None, max_entries=None):
+        """
+        Evicts all entries that were not used within the last max_age days.
+        Afterwards, evicts the least recently used entries until at most
+        max_entries remain.
+        """
+        before = len(self)
+
+        if max_age is not None:
+            deadline = time.time() - max_age * 24 * 60 * 60
+            for context, entries in self.entries.items():
+                self.entries[context] = {key: value for key, value
+                                         in entries.items()
+                                         if value[3] >= deadline}
+
+        if max_entries is not None and len(self) > max_entries:
+            last_used = sorted(value[3] for entries in self.entries.values()
+                               for value in entries.values())
+            deadline = last_used[len(last_used) - max_entries - 1]
+            for context, entries in self.entries.items():
+                self.entries[context] = {key: value for key, value
+                                         in entries.items()
+                                         if value[3] > deadline}
+
+        self.entries = {context: entries for context, entries
+                        in self.entries.items() if entries}
+
+        if before != len(self):
+            log.info('Evicted %d entries from the similarity cache' %
+                     (before - len(self)))
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        log.info('Similarity cache: %d hits, %d misses (hit ratio: %0.2f), '
+                 '%d entries' % (self.hits, self.misses, ratio, len(self)))
+
+    def __len__(self):
+        return sum([len(x) for x in self.entries.values()])
+
+    def to_file(self, filename):
+        log.info('Writing similarity cache with %d entries' % len(self))
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_file(filename, must_exist=False):
+        """
+        Loads the cache from filename. If filename does not exist and
+        must_exist is False, a new, empty cache will be returned.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                ret = pickle.load(f)
+            # Counters are per run
+            ret.hits = ret.misses = 0
+            log.info('Loaded similarity cache with %d entries' % len(ret))
+            return ret
+        except FileNotFoundError:
+            if must_exist:
+                raise
+            log.info('Similarity cache %s not found, creating a new one' %
+                     filename)
+            return SimilarityCache()
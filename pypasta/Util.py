@@ -24,6 +24,7 @@ import shutil
 import subprocess
 import sys
 
+from fuzzywuzzy.utils import full_process
 from logging import getLogger
 
 log = getLogger(__name__[-15:])
@@ -38,6 +39,30 @@ def pygit2_signature_to_datetime(signature):
     return dt
 
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def datetime_to_epoch_us(date):
+    """
+    Returns the exact number of microseconds since the epoch. Naive dates are
+    assumed to be UTC.
+    """
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return (date - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def token_sort_key(s):
+    """
+    Returns the normalised, token-sorted representation of s that
+    fuzz.token_sort_ratio() computes internally before rating two strings. Two
+    keys can be rated with fuzz.ratio(). This gives the same result as
+    fuzz.token_sort_ratio() on the original objects, but allows to normalise
+    objects only once.
+    """
+    return ' '.join(sorted(full_process(s, force_ascii=True).split()))
+
+
 def path_convert_relative(prefix, path):
     if not os.path.isabs(path) and path[0] != '~':
         return os.path.join(prefix, path)
@@ -201,7 +226,7 @@ def show_commit(repo, hash, enable_pager=True):
         content.append('---')
         content += commit.annotation
     content.append('')
-    content += commit.diff.raw
+    content += repo.get_raw_diff(hash).raw
     pager('\n'.join(content), enable_pager)
 
 
@@ -228,8 +253,8 @@ def show_commits(repo, left_hash, right_hash, enable_pager=True):
     left_annotation = left_commit.annotation
     right_annotation = right_commit.annotation
 
-    left_diff, left_footer = left_commit.diff.split_footer()
-    right_diff, right_footer = right_commit.diff.split_footer()
+    left_diff, left_footer = repo.get_raw_diff(left_hash).split_footer()
+    right_diff, right_footer = repo.get_raw_diff(right_hash).split_footer()
 
     columns, _ = shutil.get_terminal_size()
     maxlen = int((columns-3)/2)
@@ -0,0 +1,148 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import functools
+import os
+import pickle
+import time
+
+from logging import getLogger
+from multiprocessing import Pool
+
+from .Profiler import profiler, stage as profile_stage
+
+log = getLogger(__name__[-15:])
+
+# The Repository the pool was created with. Workers inherit it when they are
+# forked, as pygit2 Repository objects are not pickleable.
+_repo = None
+
+
+def worker_repository():
+    """
+    Returns the Repository of the WorkerPool of this worker
+    """
+    return _repo
+
+
+def _ready(_):
+    return True
+
+
+def _timed(f, item):
+    begin = time.time()
+    cpu = time.process_time()
+    result = f(item)
+    end = time.time()
+
+    # If profiling is enabled, send the stages of the task to the parent
+    profile = None
+    p = profiler()
+    if p is not None:
+        with profile_stage('Pickling results') as s:
+            s.items = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        profile = (os.getpid(), begin, end, time.process_time() - cpu) + \
+                  p.drain()
+
+    return end - begin, profile, result
+
+
+class WorkerPool:
+    """
+    A pool of workers that is shared by all stages of an analysis. Workers are
+    forked once, and keep warm state, e.g., attached commit stores (cf.
+    CommitStore.attach()), between tasks and stages.
+    """
+    def __init__(self, processes, repo=None):
+        """
+        :param processes: number of workers
+        :param repo: Repository that is inherited by the workers, cf.
+               worker_repository()
+        """
+        global _repo
+
+        self.processes = processes
+        self.repo = repo
+
+        # name, number of tasks, wall time and busy time of all stages
+        self.stages = list()
+
+        begin = time.time()
+        _repo = repo
+        self._pool = Pool(processes)
+        # Wait until the workers are up and running
+        self._pool.map(_ready, range(processes), chunksize=1)
+        _repo = None
+
+        self._created = time.time()
+        self.startup = self._created - begin
+        log.info('Started %d workers in %0.2fs' % (processes, self.startup))
+
+    def imap(self, f, iterable, chunksize=1, stage=None):
+        if stage is None:
+            stage = getattr(f, 'func', f).__name__
+
+        g = functools.partial(_timed, f)
+        tasks = 0
+        busy = 0.0
+
+        begin = time.time()
+        with profile_stage('%s (pool)' % stage) as s:
+            for seconds, profile, result in self._pool.imap(g, iterable,
+                                                            chunksize):
+                tasks += 1
+                busy += seconds
+                if profile is not None:
+                    profiler().merge(stage, *profile)
+                yield result
+            s.items = tasks
+        wall = time.time() - begin
+        self.stages.append((stage, tasks, wall, busy))
+
+        # Time the workers didn't spend on tasks during the stage, e.g., for
+        # passing arguments and results, or waiting for other workers
+        p = profiler()
+        if p is not None:
+            p.add('%s (idle workers)' % stage, os.getpid(), 1, tasks,
+                  max(wall * self.processes - busy, 0), 0, 0)
+
+    def map(self, f, iterable, chunksize=1, stage=None):
+        return list(self.imap(f, iterable, chunksize, stage))
+
+    def report(self):
+        lifetime = time.time() - self._created
+        available = lifetime * self.processes
+        busy = sum([x[3] for x in self.stages])
+
+        log.info('Worker pool: %d workers, startup %0.2fs, lifetime %0.1fs' %
+                 (self.processes, self.startup, lifetime))
+        for stage, tasks, wall, stage_busy in self.stages:
+            utilisation = stage_busy / (wall * self.processes) if wall else 1
+            log.info(' %s: %d tasks, %0.1fs wall time, %0.1f%% busy' %
+                     (stage, tasks, wall, utilisation * 100))
+        log.info(' Idle: %0.1fs of %0.1fs worker time' %
+                 (max(available - busy, 0), available))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
+            self._pool.join()
@@ -20,11 +20,16 @@ from .Repository import *
 from .Config import Config
 from .Clustering import Clustering
 from .PatchEvaluation import EvaluationResult, EvaluationType,\
-    evaluate_commit_list, SimRating, evaluate_commit_pair
+    evaluate_commit_list, SimRating, evaluate_commit_pair,\
+    ShardedEvaluationResult
 from .Config import Thresholds
 from .Util import format_date_ymd, load_commit_hashes, get_date_selector,\
     getch, show_commit, show_commits, parse_date_ymd, get_first_upstream
 from .PatchDynamics import PatchFlow, PatchComposition
 from .Export import Export
+from .MinHashIndex import MinHashIndex
+from .HashPrefixIndex import HashPrefixIndex
+from .SimilarityCache import SimilarityCache
+from .WorkerPool import WorkerPool
 from .LinuxMailCharacteristics import LinuxMailCharacteristics,\
     load_linux_mail_characteristics
@@ -0,0 +1,58 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+from benchmark import BenchmarkMbox, Corpus
+from pypasta import Repository
+from pypasta.Config import Thresholds
+
+# Size and seed of the fixture corpus
+PATCHES = 60
+SEED = 1
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """
+    A small, deterministic corpus of upstream commits, noise commits and mails
+    (cf. tools/benchmark.py)
+    """
+    return Corpus(str(tmp_path_factory.mktemp('corpus')), PATCHES, SEED)
+
+
+@pytest.fixture(scope='session')
+def repo(corpus):
+    repo = Repository(corpus.d_repo)
+    repo.mbox = BenchmarkMbox(corpus.f_mbox)
+    repo.cache_commits(corpus.commits + corpus.patch_mails, parallelise=False)
+    return repo
+
+
+@pytest.fixture(scope='session')
+def mails(corpus, repo):
+    """
+    Message-IDs of all mails of the corpus that contain valid patches
+    """
+    return [x for x in corpus.patch_mails if x in repo.ccache]
+
+
+@pytest.fixture
+def thresholds():
+    return Thresholds(1, 0.5, 0.2, 0.25, 0.8, 0.3, 0)
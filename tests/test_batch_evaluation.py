@@ -0,0 +1,34 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pytest
+
+from pypasta.PatchEvaluation import batch_available, evaluate_commit_batch, \
+                                    evaluate_commit_pair
+
+
+def ratings(sim_ratings):
+    return [(x.msg, x.diff, x.diff_lines_ratio, x.pruned) for x in sim_ratings]
+
+
+@pytest.mark.skipif(not batch_available,
+                    reason='batch evaluation requires RapidFuzz and NumPy')
+@pytest.mark.parametrize('prune', [False, True])
+def test_batch_equals_pairwise(repo, corpus, mails, thresholds, prune):
+    candidates = corpus.commits + mails
+    for mail in mails:
+        batch = evaluate_commit_batch(repo, thresholds, mail, candidates,
+                                      prune)
+        pairwise = [evaluate_commit_pair(repo, thresholds, mail, candidate,
+                                         prune)
+                    for candidate in candidates]
+        assert ratings(batch) == ratings(pairwise), mail
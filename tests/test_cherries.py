@@ -0,0 +1,33 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+from types import SimpleNamespace
+
+from bin.pasta_analyse import _find_cherry_references
+
+
+def test_cherry_references():
+    repo = {
+        # Hex words must not be taken for abbreviated hashes
+        'a': SimpleNamespace(message=['Fix the decade faced by added code',
+                                      'upstream commit: added decade faced']),
+        'b': SimpleNamespace(message=['Backport',
+                                      'picked from 1234abc and DEADBEEF1',
+                                      'cherry picked from commit 1234ABC']),
+        # Too short for an abbreviated hash
+        'c': SimpleNamespace(message=['upstream commit 12345ab6 is 12345']),
+    }
+
+    references, lines = _find_cherry_references(repo, ['a', 'b', 'c'])
+    assert lines == 4
+    assert references == [('b', '1234abc'), ('b', 'DEADBEEF1'),
+                          ('c', '12345ab6')]
@@ -0,0 +1,57 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pytest
+
+from pypasta.MinHashIndex import np, MinHashIndex
+from pypasta.PatchEvaluation import preevaluate_commit_list, \
+                                    preevaluate_minhash, preevaluation_recall
+
+pytestmark = pytest.mark.skipif(np is None,
+                                reason='MinHash preevaluation requires NumPy')
+
+# Default floor of evaluate_commit_list()
+FLOOR = 0.2
+
+
+def test_signature_is_universal_hash():
+    index = MinHashIndex(num_perm=8, bands=4)
+    shingles = {0, 1, 0xffffffff, 0xdeadbeefcafebabe, (1 << 64) - 1}
+
+    expected = [min(((x * int(a) + int(b)) % MinHashIndex.PRIME) &
+                    MinHashIndex.MAX_HASH for x in shingles)
+                for a, b in zip(index._a, index._b)]
+    assert index.signature(shingles).tolist() == expected
+
+
+def test_recall(corpus, repo, mails, thresholds, record_property):
+    reference = preevaluate_commit_list(repo, thresholds, mails,
+                                        corpus.commits, parallelise=False)
+    result = preevaluate_minhash(repo, thresholds, MinHashIndex(), FLOOR,
+                                 mails, corpus.commits)
+
+    # The file-based preevaluation pairs all patches that touch the same
+    # files. Most of these pairs are unrelated.
+    recall = preevaluation_recall(reference, result)
+    record_property('recall', recall)
+
+    # Pairs of the file-based preevaluation that are revisions of the same
+    # patch must not be lost
+    groups = {patch: i for i, group in enumerate(corpus.groups)
+              for patch in group}
+    related = {mail: {commit for commit in commits
+                      if groups[mail] == groups[commit]}
+               for mail, commits in reference.items()}
+    related = {mail: commits for mail, commits in related.items() if commits}
+
+    assert related
+    assert preevaluation_recall(related, result) == 1.0
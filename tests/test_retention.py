@@ -0,0 +1,45 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import pytest
+
+from pypasta.PatchEvaluation import evaluate_commit_list, retain_candidates, \
+                                    EvaluationType
+
+
+def ratings(result):
+    return {orig: sorted((cand, (rating.msg, rating.diff))
+                         for cand, rating in evaluation)
+            for orig, evaluation in result.items() if evaluation}
+
+
+@pytest.mark.parametrize('top_k, min_rating', [(1, None), (3, None),
+                                               (None, 0.5), (2, 0.3)])
+@pytest.mark.parametrize('mode', ['rep', 'upstream'])
+def test_retention(repo, corpus, mails, thresholds, mode, top_k, min_rating):
+    if mode == 'rep':
+        # Originals and candidates are the same, pairs are mirrored
+        args = False, EvaluationType.PatchStack, corpus.commits, \
+               corpus.commits
+    else:
+        # Identical mails are folded, but their candidates differ by date
+        thresholds.author_date_interval = 3
+        args = True, EvaluationType.Upstream, mails, corpus.commits
+
+    full = evaluate_commit_list(repo, thresholds, *args)
+    retained = evaluate_commit_list(repo, thresholds, *args, top_k=top_k,
+                                    min_rating=min_rating)
+
+    retention = top_k, min_rating, thresholds.message_diff_weight
+    expected = {orig: retain_candidates(evaluation, retention)
+                for orig, evaluation in full.items()}
+    assert ratings(retained) == ratings(expected)
@@ -0,0 +1,58 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+from pypasta import PatchEvaluation
+from pypasta.PatchEvaluation import evaluate_commit_list, split_evaluation, \
+                                    EvaluationType
+
+
+def commits(repo, branch, other):
+    """
+    Returns the commits of branch that are not on other
+    """
+    walker = repo.repo.walk(repo.repo.branches[branch].target)
+    walker.hide(repo.repo.branches[other].target)
+    return [str(commit.id) for commit in walker]
+
+
+def test_split_evaluation():
+    assert split_evaluation(('a', {'b', 'c'}), 4) == [('a', ['b']),
+                                                      ('a', ['c'])]
+    assert split_evaluation(('a', {'b', 'c', 'd'}), 2) == [('a', ['b', 'd']),
+                                                           ('a', ['c'])]
+
+
+def test_parallel_equals_sequential(monkeypatch, repo, thresholds):
+    def ratings(result):
+        return {orig: sorted((cand, (rating.msg, rating.diff,
+                                     rating.diff_lines_ratio))
+                             for cand, rating in evaluation)
+                for orig, evaluation in result.items()}
+
+    # Few candidates per representative, so that splits of the evaluation
+    # outnumber them
+    thresholds.author_date_interval = 3
+
+    # Enough workers to split the evaluation of representatives
+    monkeypatch.setattr(PatchEvaluation, 'cpu_count', lambda: 4)
+
+    noise = commits(repo, 'noise', 'master')
+    upstream = commits(repo, 'master', 'noise')
+
+    sequential = evaluate_commit_list(repo, thresholds, False,
+                                      EvaluationType.Upstream, noise,
+                                      upstream, parallelise=False)
+    parallel = evaluate_commit_list(repo, thresholds, False,
+                                    EvaluationType.Upstream, noise,
+                                    upstream, parallelise=True)
+
+    assert ratings(parallel) == ratings(sequential)
@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+
+Offline benchmark of PaStA. Generates a deterministic synthetic corpus -- a
+git repository and a raw mailbox with patch series, resends with small
+mutations, review replies and mails that were sent to several lists -- and
+times the main stages of an analysis on it. Results are written as JSON
+report, and can be compared against the report of a previous run.
+"""
+
+import argparse
+import email
+import json
+import mailbox
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from pypasta import Clustering, EvaluationType, Repository, Thresholds,\
+    evaluate_commit_list
+from pypasta.PatchEvaluation import preevaluate_commit_list
+from pypasta.Repository.MailThread import MailThread
+from pypasta.Repository.Mbox import PatchMail
+from pypasta.Repository.Patch import Diff
+
+# Version of the report format
+REPORT_VERSION = 1
+
+LISTS = ['linux-kernel@vger.bench', 'netdev@vger.bench']
+
+DIRECTORIES = ['drivers/net/ethernet/intel', 'drivers/gpu/drm/amd',
+               'drivers/usb/core', 'arch/arm64/kernel', 'include/linux',
+               'kernel/sched', 'fs/btrfs', 'mm', 'sound/soc/codecs', 'net/ipv4']
+
+WORDS = ('fix memory leak in probe remove unused variable add support for '
+         'device tree binding use after free refactor cleanup error path '
+         'handle null pointer dereference convert to devm helpers drop '
+         'redundant check avoid race on lock update documentation').split()
+
+TOKENS = ('return 0; } { int ret; if (ret) goto err; kfree(priv); '
+          'struct device *dev; ret = -ENOMEM; mutex_lock(&priv->lock); '
+          'mutex_unlock(&priv->lock); dev_err(dev, "failed\\n"); '
+          'for (i = 0; i < n; i++) spin_lock_irqsave(&lock, flags); '
+          'list_for_each_entry(pos, &head, list) WARN_ON(!p);').split(' ')
+
+AUTHORS = [('Jane Hacker', 'jane@bench.example'),
+           ('John Maintainer', 'john@bench.example'),
+           ('Erika Mustermann', 'erika@bench.example'),
+           ('Max Mustermann', 'max@bench.example')]
+
+
+class Corpus:
+    """
+    A deterministic synthetic corpus of patches.
+
+    All patches are commits of the repository. Patches on branch master are
+    upstream. Patches on branch noise never made it upstream. Most upstream
+    patches and all noise patches were sent to the mailing lists. Some were
+    resent with small mutations, some were sent to several lists.
+    """
+    def __init__(self, directory, patches, seed):
+        self.directory = directory
+        self.d_repo = os.path.join(directory, 'repo')
+        self.f_mbox = os.path.join(directory, 'mbox')
+
+        self._random = random.Random(seed)
+        self._time = 1500000000
+
+        # Hashes of the upstream commits
+        self.commits = list()
+        # Message-IDs of all mails that contain patches
+        self.patch_mails = list()
+        # Message-IDs of all mails
+        self.mails = list()
+        # Groups of related patches: an upstream commit, if any, and all
+        # mails of the patch
+        self.groups = list()
+
+        self._generate(patches)
+
+    def _line(self):
+        return '\t' * self._random.randint(0, 2) + \
+               ' '.join(self._random.choice(TOKENS)
+                        for _ in range(self._random.randint(1, 6)))
+
+    def _words(self, lo, hi):
+        return ' '.join(self._random.choice(WORDS)
+                        for _ in range(self._random.randint(lo, hi)))
+
+    def _message(self):
+        body = [self._words(6, 12) for _ in range(self._random.randint(1, 5))]
+        return self._words(3, 8), body
+
+    def _edit(self, content, files):
+        """
+        Edits some files of content, returns the edited files
+        """
+        edited = dict()
+        num = self._random.choice([1, 1, 1, 2, 2, 3, 5])
+        for filename in self._random.sample(files, num):
+            lines = list(edited.get(filename, content[filename]))
+            for _ in range(self._random.randint(1, 3)):
+                pos = self._random.randint(0, len(lines))
+                new = [self._line() for _ in range(self._random.randint(1, 8))]
+                kind = self._random.choice(['insert', 'delete', 'replace'])
+                if kind == 'insert':
+                    lines[pos:pos] = new
+                elif kind == 'delete':
+                    del lines[pos:pos + len(new)]
+                else:
+                    lines[pos:pos + len(new)] = new
+            edited[filename] = lines
+        return edited
+
+    @staticmethod
+    def _data(data):
+        data = data.encode('utf-8')
+        return b'data %d\n%s\n' % (len(data), data)
+
+    def _commit(self, branch, mark, parent, author, message, files):
+        self._time += self._random.randint(600, 3 * 24 * 3600)
+        name, mail = author
+        subject, body = message
+        message = '\n'.join([subject, ''] + body +
+                            ['', 'Signed-off-by: %s <%s>' % (name, mail)])
+
+        ret = b'commit refs/heads/%s\nmark :%d\n' % (branch.encode(), mark)
+        for kind in [b'author', b'committer']:
+            ret += b'%s %s <%s> %d +0000\n' % (kind, name.encode(),
+                                               mail.encode(), self._time)
+        ret += Corpus._data(message)
+        if parent:
+            ret += b'from :%d\n' % parent
+        for filename, lines in sorted(files.items()):
+            ret += b'M 100644 inline %s\n' % filename.encode()
+            ret += Corpus._data('\n'.join(lines) + '\n')
+        return ret + b'\n'
+
+    def _generate(self, patches):
+        files = ['%s/%s_%d.c' % (self._random.choice(DIRECTORIES),
+                                 self._random.choice(['core', 'main', 'dev',
+                                                      'phy', 'hw']), i)
+                 for i in range(max(patches // 4, 20))]
+        files = sorted(set(files))
+        content = {filename: [self._line() for _ in range(150)]
+                   for filename in files}
+
+        stream = self._commit('master', 1, None, AUTHORS[0],
+                              ('Initial import', []), content)
+        noise_content = dict(content)
+
+        # mark, branch, author and message of all patches
+        marks = list()
+        mark = 1
+        last = {'master': 1, 'noise': 1}
+        for _ in range(patches):
+            mark += 1
+            branch = 'noise' if self._random.random() < 0.2 else 'master'
+            tree = content if branch == 'master' else noise_content
+            author = self._random.choice(AUTHORS)
+            message = self._message()
+
+            edited = self._edit(tree, files)
+            tree.update(edited)
+            stream += self._commit(branch, mark, last[branch], author, message,
+                                   edited)
+            last[branch] = mark
+            marks.append((mark, branch, author, message))
+
+        os.makedirs(self.d_repo)
+        subprocess.run(['git', 'init', '-q', self.d_repo], check=True)
+        f_marks = os.path.join(self.directory, 'marks')
+        subprocess.run(['git', '-C', self.d_repo, 'fast-import', '--quiet',
+                        '--export-marks=%s' % f_marks], input=stream,
+                       check=True)
+        with open(f_marks) as f:
+            hashes = dict(line.split() for line in f)
+
+        repo = Repository(self.d_repo).repo
+        mails = list()
+        for mark, branch, author, message in marks:
+            hash = hashes[':%d' % mark]
+            commit = repo[hash]
+            diff = repo.diff(commit.parents[0], commit).patch or ''
+            if branch == 'master':
+                self.commits.append(hash)
+            mails.append((hash if branch == 'master' else None, author,
+                          message, commit.author.time, diff))
+
+        self._write_mbox(mails)
+
+    def _mutate(self, message, diff):
+        subject, body = message
+        words = subject.split()
+        words[self._random.randrange(len(words))] = \
+            self._random.choice(WORDS)
+        message = ' '.join(words), body
+
+        lines = diff.split('\n')
+        added = [i for i, line in enumerate(lines)
+                 if line.startswith('+') and not line.startswith('+++')]
+        for i in self._random.sample(added, min(len(added), 2)):
+            lines[i] += ' /* v2 */'
+        return message, '\n'.join(lines)
+
+    def _write_mbox(self, mails):
+        ret = mailbox.mbox(self.f_mbox, create=True)
+
+        def add(id, author, subject, date, body, reply_to=None, lists=None):
+            name, mail = author
+            date = datetime.fromtimestamp(date, timezone.utc)
+            for listaddr in lists or LISTS[:1]:
+                headers = ['From: %s <%s>' % (name, mail),
+                           'To: %s' % listaddr,
+                           'Subject: %s' % subject,
+                           'Date: %s' % format_datetime(date),
+                           'Message-ID: %s' % id]
+                if reply_to:
+                    headers += ['In-Reply-To: %s' % reply_to,
+                                'References: %s' % reply_to]
+                message = mailbox.mboxMessage('\n'.join(headers) + '\n\n' +
+                                              body + '\n')
+                message.set_from(mail, date.timetuple())
+                ret.add(message)
+            self.mails.append(id)
+
+        i = 0
+        series = 0
+        while i < len(mails):
+            series += 1
+            length = self._random.choice([1, 1, 2, 3, 5])
+            patches = mails[i:i + length]
+            i += length
+
+            # Sent to several lists
+            lists = LISTS if self._random.random() < 0.2 else LISTS[:1]
+            # Resent as v2
+            versions = 2 if self._random.random() < 0.3 else 1
+
+            for version in range(1, versions + 1):
+                prefix = 'PATCH' if version == 1 else 'PATCH v%d' % version
+                cover = None
+                if len(patches) > 1:
+                    cover = '<%d-v%d-0@bench.example>' % (series, version)
+                    add(cover, patches[0][1],
+                        '[%s 0/%d] %s' % (prefix, len(patches),
+                                          self._words(3, 6)),
+                        patches[0][3], self._words(10, 20), lists=lists)
+
+                for number, patch in enumerate(patches, 1):
+                    hash, author, message, date, diff = patch
+                    if version > 1:
+                        message, diff = self._mutate(message, diff)
+                        patches[number - 1] = hash, author, message, date, diff
+
+                    id = '<%d-v%d-%d@bench.example>' % (series, version,
+                                                        number)
+                    subject, body = message
+                    if len(patches) > 1:
+                        subject = '[%s %d/%d] %s' % (prefix, number,
+                                                     len(patches), subject)
+                    else:
+                        subject = '[%s] %s' % (prefix, subject)
+                    name, mail = author
+                    content = '\n'.join(body + ['', 'Signed-off-by: %s <%s>' %
+                                                (name, mail), '---', diff])
+                    add(id, author, subject, date + version * 86400, content,
+                        reply_to=cover, lists=lists)
+                    self.patch_mails.append(id)
+
+                    if version == 1:
+                        self.groups.append(([hash] if hash else []) + [id])
+                    else:
+                        self.groups[-len(patches) + number - 1].append(id)
+
+                    # A review
+                    if self._random.random() < 0.3:
+                        reviewer = self._random.choice(AUTHORS)
+                        add('<review-%s' % id[1:], reviewer,
+                            'Re: %s' % subject, date + version * 86400 + 3600,
+                            '> %s\n\n%s' % (body[0], self._words(5, 15)),
+                            reply_to=id, lists=lists)
+
+        ret.flush()
+        ret.close()
+
+
+def tree_wide_diff(seed, lines):
+    """
+    Returns a synthetic tree-wide diff of about lines lines, e.g., an API
+    conversion that touches many files with small hunks, and renames files
+    """
+    rng = random.Random(seed)
+
+    def line():
+        return '\t' + ' '.join(rng.choice(TOKENS)
+                                for _ in range(rng.randint(1, 6)))
+
+    diff = list()
+    file = 0
+    while len(diff) < lines:
+        file += 1
+        filename = '%s/tree_wide_%d.c' % (rng.choice(DIRECTORIES), file)
+        if rng.random() < 0.05:
+            diff += ['diff --git a/%s b/%s.old' % (filename, filename),
+                     'similarity index 100%',
+                     'rename from %s' % filename,
+                     'rename to %s.old' % filename]
+            continue
+
+        diff += ['diff --git a/%s b/%s' % (filename, filename),
+                 'index 0123456..789abcd 100644',
+                 '--- a/%s' % filename,
+                 '+++ b/%s' % filename]
+        start = 1
+        for _ in range(rng.randint(1, 20)):
+            start += rng.randint(10, 200)
+            deletions = rng.randint(0, 4)
+            insertions = rng.randint(0, 4)
+            diff.append('@@ -%d,%d +%d,%d @@ static int probe(struct device *dev)'
+                        % (start, deletions + 6, start, insertions + 6))
+            diff += [' ' + line() for _ in range(3)]
+            diff += ['-' + line() for _ in range(deletions)]
+            diff += ['+' + line() for _ in range(insertions)]
+            diff += [' ' + line() for _ in range(3)]
+
+    return diff + ['-- ', '2.25.1', '']
+
+
+def largest_diffs(d_repo, count, scan):
+    """
+    Returns the diffs of the count largest commits with a single parent among
+    the last scan commits of the repository d_repo
+    """
+    log = subprocess.check_output(['git', '-C', d_repo, 'log',
+                                   '--min-parents=1', '--max-parents=1',
+                                   '-n', str(scan), '--format=commit %H',
+                                   '--shortstat'],
+                                  universal_newlines=True)
+    sizes = list()
+    for entry in log.split('commit ')[1:]:
+        commit, *stat = entry.split('\n')
+        changes = sum(int(x.split()[0]) for x in ' '.join(stat).split(',')
+                      if 'insertion' in x or 'deletion' in x)
+        sizes.append((changes, commit))
+    sizes.sort(reverse=True)
+
+    repo = Repository(d_repo).repo
+    diffs = list()
+    for _, commit in sizes[:count]:
+        commit = repo[commit]
+        diff = repo.diff(commit.parents[0], commit)
+        diff.find_similar()
+        diffs.append((diff.patch or '').split('\n'))
+    return diffs
+
+
+class BenchmarkMbox:
+    """
+    The mails of a raw mailbox, with the interface of Mbox that PaStA uses
+    for analyses
+    """
+    def __init__(self, f_mbox):
+        self.invalid = set()
+        # key: Message-ID, value: list of raw mails
+        self.raws = dict()
+
+        mbox = mailbox.mbox(f_mbox, create=False)
+        for key in mbox.iterkeys():
+            raw = mbox.get_bytes(key)
+            id = email.message_from_bytes(raw)['Message-ID']
+            self.raws.setdefault(id, list()).append(raw)
+        mbox.close()
+
+    def get_ids(self, time_window=None, allow_invalid=False, lists=None):
+        ids = set(self.raws.keys())
+        if not allow_invalid:
+            ids -= self.invalid
+        return ids
+
+    def get_raws(self, message_id):
+        return self.raws.get(message_id, list())
+
+    def get_messages(self, id):
+        return [email.message_from_bytes(raw) for raw in self.get_raws(id)]
+
+    def invalidate(self, invalid):
+        self.invalid |= set(invalid)
+
+    def __contains__(self, message_id):
+        return message_id in self.raws
+
+    def __getitem__(self, message_id):
+        return self.get_patch(message_id)
+
+    def get_patch(self, message_id, eager=False):
+        exception = KeyError('Message not found')
+        for message in self.get_messages(message_id):
+            try:
+                return PatchMail(message, message_id, eager)
+            except Exception as e:
+                exception = e
+        raise exception
+
+
+def benchmarks(corpus, args, real_diffs):
+    """
+    Yields the name, the function, and the number of items of all benchmarks.
+    Functions return the time of the benchmarked operation.
+    """
+    def repository():
+        repo = Repository(corpus.d_repo)
+        repo.mbox = BenchmarkMbox(corpus.f_mbox)
+        return repo
+
+    thresholds = Thresholds(1, 0.5, args.dlr, 0.25, 1.0, 0.3, 0)
+    fuzzy = Thresholds(1, 0.5, args.dlr, 0.25, args.tf, 0.3, 0)
+
+    # The parsed repository and mailbox are shared by all benchmarks that
+    # don't measure parsing
+    repo = repository()
+    repo.cache_commits(corpus.commits + corpus.patch_mails, parallelise=False)
+    mails = [x for x in corpus.patch_mails if x in repo.ccache]
+
+    diffs = [repo.repo.diff(repo.repo[x].parents[0], repo.repo[x]).patch or ''
+             for x in corpus.commits]
+    diffs = [x.split('\n') for x in diffs]
+    messages = [(x, repo.mbox.get_messages(x)[0]) for x in corpus.patch_mails]
+
+    def timed(f, *args, **kwargs):
+        start = timer()
+        f(*args, **kwargs)
+        return timer() - start
+
+    def diff_parsing():
+        return timed(lambda: [Diff(x) for x in diffs])
+
+    def parsing(diffs):
+        return lambda: timed(lambda: [Diff(x) for x in diffs])
+
+    def pygit2_diffs():
+        # pygit2 generates the patches of a diff on first access. Measure it,
+        # it is part of creating the Diff of a commit.
+        ret = []
+        for x in corpus.commits:
+            diff = repo.repo.diff(repo.repo[x].parents[0], repo.repo[x])
+            diff.find_similar()
+            ret.append(diff)
+        return ret
+
+    def commit_diffs(native):
+        if native:
+            return lambda: timed(lambda x: [Diff.from_pygit2(y) for y in x],
+                                 pygit2_diffs())
+        return lambda: timed(lambda x: [Diff((y.patch or '').split('\n'))
+                                        for y in x], pygit2_diffs())
+
+    def patch_mails(eager):
+        return lambda: timed(lambda: [PatchMail(message, id, eager)
+                                      for id, message in messages])
+
+    def cache_commits():
+        fresh = repository()
+        return timed(fresh.cache_commits, corpus.commits + corpus.patch_mails,
+                     parallelise=args.parallel)
+
+    def preevaluate(thresholds):
+        return lambda: timed(preevaluate_commit_list, repo, thresholds, mails,
+                             corpus.commits, parallelise=args.parallel)
+
+    def evaluate(originals, candidates):
+        return lambda: timed(evaluate_commit_list, repo, thresholds, True,
+                             EvaluationType.Upstream, originals, candidates,
+                             parallelise=args.parallel,
+                             cpu_factor=1 if args.parallel else 0)
+
+    def mail_thread():
+        f_cache = os.path.join(corpus.directory, 'threads.pkl')
+        threads = MailThread(repo.mbox, f_cache)
+        return timed(threads.update, parallelise=args.parallel)
+
+    def clustering_insert():
+        cluster = Clustering()
+        start = timer()
+        for group in corpus.groups:
+            cluster.insert(*group)
+        for hash in corpus.commits:
+            cluster.mark_upstream(hash, True)
+        return timer() - start, cluster
+
+    def clustering_representatives():
+        _, cluster = clustering_insert()
+        return timed(cluster.get_representative_system,
+                     lambda x, y: x > y)
+
+    def clustering_file():
+        _, cluster = clustering_insert()
+        filename = os.path.join(corpus.directory, 'cluster')
+        start = timer()
+        cluster.to_file(filename)
+        Clustering.from_file(filename)
+        return timer() - start
+
+    groups = len(corpus.groups)
+    yield 'Diff parsing', diff_parsing, len(diffs)
+    tree_wide = tree_wide_diff(args.seed, args.large)
+    yield 'Diff parsing (tree-wide, %d lines)' % args.large, \
+          parsing([tree_wide]), len(tree_wide)
+    if args.real_diffs:
+        yield 'Diff parsing (largest of %s)' % \
+              os.path.basename(os.path.abspath(args.real_diffs)), \
+              parsing(real_diffs), sum(len(x) for x in real_diffs)
+    yield 'Commit diffs (rendered and parsed)', commit_diffs(False), \
+          len(corpus.commits)
+    yield 'Commit diffs (from pygit2)', commit_diffs(True), len(corpus.commits)
+    yield 'PatchMail', patch_mails(True), len(messages)
+    yield 'PatchMail (without diff)', patch_mails(False), len(messages)
+    yield 'cache_commits', cache_commits, \
+          len(corpus.commits) + len(corpus.patch_mails)
+    yield 'preevaluate_commit_list', preevaluate(thresholds), len(mails)
+    yield 'preevaluate_commit_list (tf=%0.2f)' % args.tf, preevaluate(fuzzy), \
+          len(mails)
+    yield 'evaluate_commit_list (upstream)', \
+          evaluate(mails, corpus.commits), len(mails)
+    yield 'evaluate_commit_list (rep)', evaluate(mails, mails), len(mails)
+    yield 'MailThread.update', mail_thread, len(corpus.mails)
+    yield 'Clustering.insert', lambda: clustering_insert()[0], groups
+    yield 'Clustering.get_representative_system', \
+          clustering_representatives, groups
+    yield 'Clustering.to_file/from_file', clustering_file, groups
+
+
+def compare(report, baseline):
+    baseline = {(x['patches'], x['benchmark']): x['seconds']
+                for x in baseline['results']}
+
+    print('\nComparison against baseline:')
+    print('%8s %-45s %12s %12s %8s' %
+          ('patches', 'benchmark', 'baseline [s]', 'this [s]', 'speedup'))
+    for result in report['results']:
+        old = baseline.get((result['patches'], result['benchmark']))
+        if old is None:
+            continue
+        new = result['seconds']
+        print('%8d %-45s %12.3f %12.3f %7.2fx' %
+              (result['patches'], result['benchmark'], old, new,
+               old / new if new else float('inf')))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark PaStA on a '
+                                                 'synthetic corpus')
+    parser.add_argument('-patches', type=int, nargs='+',
+                        default=[100, 250, 500],
+                        help='Sizes of the corpus in patches '
+                             '(default: %(default)s)')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='Repetitions of each benchmark. The fastest '
+                             'repetition is reported. (default: %(default)s)')
+    parser.add_argument('-tf', type=float, default=0.8,
+                        help='Filename threshold of the fuzzy preevaluation '
+                             '(default: %(default)s)')
+    parser.add_argument('-dlr', type=float, default=0.2,
+                        help='Diff lines ratio threshold '
+                             '(default: %(default)s)')
+    parser.add_argument('-parallel', action='store_true', default=False,
+                        help='Run parallelisable stages in parallel')
+    parser.add_argument('-large', type=int, default=50000,
+                        help='Lines of the synthetic tree-wide diff '
+                             '(default: %(default)s)')
+    parser.add_argument('-diffs', dest='real_diffs', metavar='repository',
+                        default=None,
+                        help='Additionally parse the diffs of the largest '
+                             'recent commits of this repository, e.g., '
+                             'Linux')
+    parser.add_argument('-seed', type=int, default=1)
+    parser.add_argument('-o', dest='output', default='benchmark.json',
+                        help='JSON report (default: %(default)s)')
+    parser.add_argument('-compare', metavar='report', default=None,
+                        help='Compare against the JSON report of a previous '
+                             'run')
+    parser.add_argument('-keep', metavar='directory', default=None,
+                        help='Generate the corpora in directory, and keep '
+                             'them')
+    args = parser.parse_args(argv)
+
+    real_diffs = None
+    if args.real_diffs:
+        real_diffs = largest_diffs(args.real_diffs, 10, 5000)
+
+    directory = args.keep or tempfile.mkdtemp(prefix='pasta-benchmark-')
+    report = {'version': REPORT_VERSION,
+              'date': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'seed': args.seed,
+              'repeat': args.repeat,
+              'parallel': args.parallel,
+              'results': list()}
+
+    print('%8s %-45s %8s %12s %12s' %
+          ('patches', 'benchmark', 'items', 'time [s]', 'items/s'))
+    try:
+        for patches in args.patches:
+            d_corpus = os.path.join(directory, str(patches))
+            if os.path.isdir(d_corpus):
+                shutil.rmtree(d_corpus)
+            os.makedirs(d_corpus)
+
+            start = timer()
+            corpus = Corpus(d_corpus, patches, args.seed)
+            report['results'].append({'patches': patches,
+                                      'benchmark': 'Corpus generation',
+                                      'seconds': timer() - start,
+                                      'items': len(corpus.mails)})
+
+            for name, f, items in benchmarks(corpus, args, real_diffs):
+                seconds = min(f() for _ in range(args.repeat))
+                report['results'].append({'patches': patches,
+                                          'benchmark': name,
+                                          'seconds': seconds,
+                                          'items': items})
+                print('%8d %-45s %8d %12.3f %12.1f' %
+                      (patches, name, items, seconds,
+                       items / seconds if seconds else float('inf')))
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote report to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) agent, 2026
+
+Author:
+  agent <agent@local>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+
+Micro-benchmark of best_string_mapping() for patches that touch hundreds of
+files, such as tree-wide renames. Compares the mapping against the plain
+cross product of all filenames.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from pypasta.PatchEvaluation import best_string_mapping, rate_keys
+from pypasta.Util import token_sort_key
+
+
+def cross_product_mapping(threshold, left_list, right_list):
+    keys = {x: token_sort_key(x) for x in left_list + right_list}
+
+    def injective_map(ll, rl, inverse_result=False):
+        ret = dict()
+        for l_entry in ll:
+            for r_entry in rl:
+                if l_entry == r_entry:
+                    sim = 1
+                else:
+                    sim = rate_keys(keys[l_entry], keys[r_entry]) / 100
+
+                if sim < threshold:
+                    continue
+
+                if l_entry in ret:
+                    _, old_sim = ret[l_entry]
+                    if sim < old_sim:
+                        continue
+
+                ret[l_entry] = r_entry, sim
+        return {(r, l) if inverse_result else (l, r)
+                for l, (r, _) in ret.items()}
+
+    return injective_map(left_list, right_list) | \
+           injective_map(right_list, left_list, True)
+
+
+def tree_wide_rename(generator, files, renamed):
+    dirs = ['drivers/net/ethernet', 'drivers/gpu/drm', 'arch/arm64/boot/dts',
+            'include/linux', 'sound/soc/codecs', 'fs/btrfs', 'kernel/sched']
+    left = ['%s/%s_%d.c' % (generator.choice(dirs),
+                            generator.choice(['core', 'main', 'dev', 'phy']),
+                            i) for i in range(files)]
+
+    right = list(left)
+    for i in generator.sample(range(files), renamed):
+        right[i] = right[i].replace('.c', '_v2.c')
+    generator.shuffle(right)
+
+    return left, right
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark filename mapping')
+    parser.add_argument('-files', type=int, nargs='+', default=[100, 250, 500],
+                        help='Number of touched files (default: %(default)s)')
+    parser.add_argument('-renamed', type=float, default=0.05,
+                        help='Ratio of renamed files (default: %(default)s)')
+    parser.add_argument('-tf', type=float, default=0.8,
+                        help='Filename threshold (default: %(default)s)')
+    parser.add_argument('-seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    generator = random.Random(args.seed)
+    print('%6s %8s %12s %12s %8s' %
+          ('files', 'renamed', 'cross [s]', 'mapping [s]', 'speedup'))
+
+    for files in args.files:
+        renamed = int(files * args.renamed)
+        left, right = tree_wide_rename(generator, files, renamed)
+
+        start = timer()
+        reference = cross_product_mapping(args.tf, left, right)
+        t_reference = timer() - start
+
+        start = timer()
+        mapping = best_string_mapping(args.tf, left, right)
+        t_mapping = timer() - start
+
+        if mapping != reference:
+            print('Mappings differ for %d files' % files)
+            return -1
+
+        print('%6d %8d %12.3f %12.3f %7.1fx' %
+              (files, renamed, t_reference, t_mapping,
+               t_reference / t_mapping))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))